@@ -2,12 +2,13 @@ from __future__ import print_function, division, unicode_literals
 import tensorflow as tf
 import tensorflow.contrib.slim.nets
 import numpy as np
-from base import SegmentationModel, PretrainedSegmentationModel
+import distutils.util
+from base import SegmentationModel, PretrainedSegmentationModel, FrozenSegmentationModel
 
 
 class SimpleSegA(SegmentationModel):
-    def __init__(self, name, img_shape, n_channels=3, n_classes=1, dynamic=False, l2=None, best_evals_metric="valid_iou"):
-        super().__init__(name=name, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric)
+    def __init__(self, name, img_shape, n_channels=3, n_classes=1, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
+        super().__init__(name=name, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric, read_only=read_only)
 
     def create_body_ops(self):
         """ Ops to make use of:
@@ -85,8 +86,8 @@ class SimpleSegA(SegmentationModel):
 
 
 class InceptionV3_SegmenterA(PretrainedSegmentationModel):
-    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou"):
-        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric)
+    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
+        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric, read_only=read_only)
 
     def create_body_ops(self):
         """ Inception V3  model
@@ -218,8 +219,8 @@ class InceptionV3_SegmenterA(PretrainedSegmentationModel):
 
 
 class InceptionV3_SegmenterB(PretrainedSegmentationModel):
-    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou"):
-        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric)
+    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
+        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric, read_only=read_only)
 
     def create_body_ops(self):
         """ Inception V3  model
@@ -358,8 +359,8 @@ class InceptionV3_SegmenterB(PretrainedSegmentationModel):
 
 
 class InceptionV3_SegmenterC(PretrainedSegmentationModel):
-    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou"):
-        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric)
+    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
+        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric, read_only=read_only)
 
     def create_body_ops(self):
         """ Inception V3  model
@@ -493,8 +494,8 @@ class InceptionV3_SegmenterC(PretrainedSegmentationModel):
 
 
 class InceptionV3_SegmenterD(PretrainedSegmentationModel):
-    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou"):
-        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric)
+    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
+        super().__init__(name=name, pretrained_snapshot=pretrained_snapshot, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric, read_only=read_only)
 
     def create_body_ops(self):
         """ Inception V3  model
@@ -632,3 +633,46 @@ arc["InceptionV3_SegmenterA"] = InceptionV3_SegmenterA
 arc["InceptionV3_SegmenterB"] = InceptionV3_SegmenterB
 arc["InceptionV3_SegmenterC"] = InceptionV3_SegmenterC
 arc["InceptionV3_SegmenterD"] = InceptionV3_SegmenterD
+
+
+def build_model(arc_name, name, img_shape, n_classes=1, pretrained_snapshot=None, best_evals_metric="valid_iou", read_only=False):
+    """ Creates the model object for the architecture `arc_name` (a key in
+        `arc`), and builds its graph. Handles the fact that only the
+        pretrained architectures take a `pretrained_snapshot` argument.
+        See `SegmentationModel` for `read_only`.
+    """
+    ModelClass = arc[arc_name]
+    kwargs = {
+        "name":name,
+        "img_shape":img_shape,
+        "n_channels":3,
+        "n_classes":n_classes,
+        "dynamic":False,
+        "best_evals_metric":best_evals_metric,
+        "read_only":read_only,
+        }
+    if issubclass(ModelClass, PretrainedSegmentationModel):
+        kwargs["pretrained_snapshot"] = pretrained_snapshot
+    model = ModelClass(**kwargs)
+    model.create_graph()
+    return model
+
+
+def load_model(arc_name, name, img_dim, graph=None):
+    """ Returns the model to run inference with. Either a
+        `FrozenSegmentationModel` from the frozen `graph` file (if given), or
+        the model `name` built with the architecture `arc_name` for square
+        images of side `img_dim`. """
+    if graph is not None:
+        return FrozenSegmentationModel(graph)
+    return build_model(arc_name, name=name, img_shape=[img_dim, img_dim])
+
+
+def add_model_args(p):
+    """ Adds the command line arguments used by `load_model()` (name, --arc,
+        --img_dim, --graph), and --best, to the argparse parser `p` """
+    p.add_argument("name", type=str, help="model name")
+    p.add_argument("--arc", type=str, help="model architecture")
+    p.add_argument("-d", "--img_dim", type=int, default=299, help="image dimension (64, 128, 224, 299)")
+    p.add_argument("-g", "--graph", type=str, default=None, help="Path to a frozen graph file (from export_graph.py) to use instead of the model snapshots")
+    p.add_argument("--best", default=True, type=lambda x:bool(distutils.util.strtobool(x)), help="Use best snapshot? False uses latest snapshot")
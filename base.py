@@ -6,12 +6,23 @@ operations.
 import tensorflow as tf
 import numpy as np
 import os
+import errno
+import tempfile
 import shutil
 import time
 import pickle
+import random
+import json
+import PIL.Image
 
 from viz import train_curves, vizseg, batch2grid
-from data_processing import maybe_make_pardir, pickle2obj, obj2pickle, str2file
+from data_processing import maybe_make_pardir, pickle2obj, obj2pickle, str2file, dict2jsonl, jsonl2dicts
+from registry import session_registry
+from metrics import iou_score, confusion_matrix, scores_from_confusion, ProbabilityHistogramEvaluator
+from prediction_cache import PredictionCache
+from sampling import DifficultyIndex
+from profiling import trace_run
+from memory import MemoryTracker
 
 # TODO: URGENT:  load_batch_of_images does not exist.
 # from dynamic_data import load_batch_of_images
@@ -32,10 +43,158 @@ def pretty_time(t):
 
 
 # ##############################################################################
-#                                               SEMANTIC SEGMENTATION MODEL BASE
+#                                                    SEGMENTATION INFERENCE BASE
 # ##############################################################################
 # Depends on load_batch_of_images()
-class SegmentationModel(object):
+class SegmentationInference(object):
+    """ The inference methods shared by `SegmentationModel` and
+        `FrozenSegmentationModel`. They only rely on the `X`,
+        `is_training`, `preds` and `probs` tensors of `self.graph`, and the
+        `img_height`, `img_width`, `n_classes`, `single_class_mode`,
+        `dynamic`, `profile_dir` and `profile_n_top` attributes.
+    """
+    def create_session(self, config=None):
+        """ Creates and returns a session. Be careful to close it
+            Ideally use it as follows:
+
+            with model.create_session() as session:
+                # Do something with the session here
+                ...
+
+            config: (tf.ConfigProto or None) eg. to limit the num of threads
+        """
+        session = tf.Session(graph=self.graph, config=config)
+        return session
+
+    def run_in_session(self, session, fetches, feed_dict, trace_tag=None):
+        """ Runs the fetches. If a `trace_tag` is given, the run is fully
+            traced, and the trace is saved to `profile_dir/<trace_tag>.json`
+            (see `profiling.trace_run()`) """
+        if trace_tag is None:
+            return session.run(fetches, feed_dict=feed_dict)
+        trace_file = os.path.join(self.profile_dir, "{}.json".format(trace_tag))
+        title = "{} - {}".format(type(self).__name__, trace_tag)
+        return trace_run(session, fetches, feed_dict, trace_file, n_top=self.profile_n_top, title=title)
+
+    def get_batch(self, i, batch_size, X, Y=None):
+        """ Get the ith batch from the data."""
+        X_batch = X[batch_size*i: batch_size*(i+1)]
+        # Handle dynamic loading option
+        if self.dynamic:
+            X_batch = load_batch_of_images(X_batch, img_shape=self.img_shape)
+
+        # Batch of labels if needed
+        if Y is not None:
+            Y_batch = Y[batch_size*i: batch_size*(i+1)]
+            return X_batch, Y_batch
+        else:
+            return X_batch
+
+    def predict_in_session(self, X, session, batch_size=32, verbose=True, out=None, profile_batches=None):
+        """Given input X make a forward pass of the model to get predictions
+
+           out: (array or None) Where to write the predictions, of shape
+                [n_samples, height, width]. eg a disk backed array created
+                with `np.lib.format.open_memmap()`, so that predictions for
+                large inputs do not need to fit in memory.
+                If None, a new array is created.
+           profile_batches: (list of ints or None) Indices of the batches to
+                capture a full trace of. See `run_in_session()`.
+        """
+        # Dimensions
+        n_samples = X.shape[0]
+        n_batches = int(np.ceil(n_samples/batch_size))
+        if out is None:
+            preds = np.zeros([n_samples, self.img_height, self.img_width], dtype=np.uint8)
+        else:
+            preds = out
+        if verbose:
+            print("MAKING PREDICTIONS")
+            percent_interval=10
+            print_every = n_batches/percent_interval
+            percent = 0
+
+        # MAKE PREDICTIONS ON MINI BATCHES
+        for i, batch_preds in enumerate(self.predict_batches_in_session(X, session=session, batch_size=batch_size, profile_batches=profile_batches)):
+            preds[batch_size*i: batch_size*(i+1)] = batch_preds
+
+            if verbose and (i+1)%print_every == 0:
+                percent += percent_interval
+                print("- {} %".format(percent))
+
+        return preds
+
+    def predict_batches_in_session(self, X, session, batch_size=32, profile_batches=None):
+        """Generator that yields the predictions of each batch of `batch_size`
+           samples of X, of shape [batch_size, height, width], as soon as they
+           are ready."""
+        n_batches = int(np.ceil(X.shape[0]/batch_size))
+        X_batches = (self.get_batch(i, batch_size=batch_size, X=X) for i in range(n_batches))
+        return self.predict_stream_in_session(X_batches, session=session, profile_batches=profile_batches)
+
+    def predict_stream_in_session(self, X_batches, session, profile_batches=None):
+        """Generator that takes an iterable of input batches (eg. another
+           generator decoding video frames or image files), and yields the
+           predictions of each one, of shape [n, height, width], as soon as
+           they are ready. Only one batch is held in memory at a time."""
+        for i, X_batch in enumerate(X_batches):
+            feed_dict = {self.X:X_batch, self.is_training:False}
+            trace_tag = "predict_batch_{:05d}".format(i) if profile_batches is not None and i in profile_batches else None
+            batch_preds = self.run_in_session(session, self.preds, feed_dict=feed_dict, trace_tag=trace_tag)
+            yield batch_preds.reshape([-1, self.img_height, self.img_width]).astype(np.uint8)
+
+    def predict_to_files_in_session(self, X, files, session, batch_size=32):
+        """Makes predictions on X, and saves each one as a png image to the
+           corresponding path in `files` (0=non-road, 255=road) as soon as its
+           batch is done."""
+        assert len(files) == X.shape[0], "Need one output file per sample"
+        for i, batch_preds in enumerate(self.predict_batches_in_session(X, session=session, batch_size=batch_size)):
+            for pred, file in zip(batch_preds, files[batch_size*i: batch_size*(i+1)]):
+                maybe_make_pardir(file)
+                PIL.Image.fromarray((pred==1).astype(np.uint8)*255).save(file, "PNG")
+
+    def predict_probs_in_session(self, X, session, batch_size=32):
+        """Given input X make a forward pass of the model to get the class
+           probabilities of each pixel, of shape [n_samples, height, width,
+           n_classes]"""
+        n_samples = X.shape[0]
+        n_batches = int(np.ceil(n_samples/batch_size))
+        probs = np.zeros([n_samples, self.img_height, self.img_width, self.n_classes], dtype=np.float32)
+        for i in range(n_batches):
+            X_batch = self.get_batch(i, batch_size=batch_size, X=X)
+            feed_dict = {self.X:X_batch, self.is_training:False}
+            probs[batch_size*i: batch_size*(i+1)] = session.run(self.probs, feed_dict=feed_dict)
+        return probs
+
+    def evaluate_pr_in_session(self, X, Y, session, batch_size=32, n_bins=256):
+        """Evaluates the road class over all confidence thresholds in a single
+           pass, the way the KITTI road benchmark ranks models.
+           Returns a dictionary with "max_f", "ap", and the "threshold",
+           "precision" and "recall" at MaxF.
+           See `metrics.ProbabilityHistogramEvaluator`
+        """
+        evaluator = ProbabilityHistogramEvaluator(n_bins=n_bins)
+        n_batches = int(np.ceil(len(Y)/batch_size))
+        for i in range(n_batches):
+            X_batch, Y_batch = self.get_batch(i, batch_size=batch_size, X=X, Y=Y)
+            probs = session.run(self.probs, feed_dict={self.X:X_batch, self.is_training:False})
+            evaluator.update(Y_batch, probs[..., 1])
+        return evaluator.scores()
+
+    def iou_from_confusion_mtx(self, confusion_mtx):
+        """ Given a confusion matrix of shape [n_classes, n_classes] (rows
+            are labels, columns are predictions), it returns the IoU score.
+            In single class mode this is the IoU of class 1, otherwise it is
+            the mean IoU over the classes that are present.
+        """
+        class_id = 1 if self.single_class_mode else None # the class of interest
+        return iou_score(confusion_mtx, class_id=class_id)
+
+
+# ##############################################################################
+#                                               SEMANTIC SEGMENTATION MODEL BASE
+# ##############################################################################
+class SegmentationModel(SegmentationInference):
     """
     Examples:
         # Creating a Model that inherits from this class:
@@ -48,13 +207,20 @@ class SegmentationModel(object):
                 ...
                 self.logits = ...
     """
-    def __init__(self, name, img_shape, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou"):
+    def __init__(self, name, img_shape, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
         """ Initializes a Classifier Class
             n_classes: (int)
             dynamic: (bool)(default=False)
                      Load the images dynamically?
                      If the data just contains paths to image files, and not
                      the images themselves, then set to True.
+            read_only: (bool)(default=False)
+                     Only use the model for inference/evaluation. Nothing
+                     gets written to the model directory (no directories
+                     are created, the epoch log is not migrated, and there
+                     is no tensorboard writer), so it is safe to use on a
+                     model that is being used by other processes. It can not
+                     be trained.
 
             If logits_func is None, then you should create a new class that inherits
             from this one that overides `self.body()`
@@ -80,29 +246,46 @@ class SegmentationModel(object):
         self.img_width, self.img_height = img_shape
         self.n_channels = n_channels
         self.dynamic = dynamic
+        self.read_only = read_only
         self.global_epoch = 0
+        self.global_step = 0
+        self.train_order = None # order of training data relative to input
+        self.batch_order = None # sample ids drawn for current epoch (hard sampling)
 
         # IMPORTANT FILES
         self.model_dir = os.path.join("models", name)
         self.snapshot_file = os.path.join(self.model_dir, "snapshots", "snapshot.chk")
         self.best_snapshot_file = os.path.join(self.model_dir, "snapshots_best", "snapshot.chk")
+        self.step_snapshot_file = os.path.join(self.model_dir, "snapshots_step", "snapshot.chk")
+        self.step_state_file = os.path.join(self.model_dir, "snapshots_step", "state.pickle")
+        self.difficulty_file = os.path.join(self.model_dir, "sample_difficulty.pickle")
         self.evals_file = os.path.join(self.model_dir, "evals.pickle")
+        self.metrics_file = os.path.join(self.model_dir, "metrics.jsonl")
+        self.epochs_file = os.path.join(self.model_dir, "epochs.jsonl")
         self.best_score_file = os.path.join(self.model_dir, "best_score.txt")
         self.train_status_file = os.path.join(self.model_dir, "train_status.txt")
+        self.info_file = os.path.join(self.model_dir, "model_info.json")
+        self.memory_report_file = os.path.join(self.model_dir, "memory_report.txt")
         self.tensorboard_dir = os.path.join(self.model_dir, "tensorboard")
+        self.profile_dir = os.path.join(self.model_dir, "profiles")
+        self.profile_n_top = 20 # Num of most expensive ops to print when profiling
+        self.prediction_cache = PredictionCache(os.path.join(self.model_dir, "pred_cache"))
 
         # DIRECTORIES TO CREATE
         self.dir_structure = [
             self.model_dir,
             os.path.join(self.model_dir, "snapshots"),
             os.path.join(self.model_dir, "snapshots_best"),
+            os.path.join(self.model_dir, "snapshots_step"),
             os.path.join(self.model_dir, "tensorboard"),
             ]
-        self.create_directory_structure()
+        if not self.read_only:
+            self.create_directory_structure()
 
         # EVALS DICTIONARY
         self.initialize_evals_dict(["train_iou", "valid_iou", "train_loss", "valid_loss", "global_epoch"])
         self.global_epoch = self.evals["global_epoch"]
+        self.global_step = self.evals.get("global_step", 0)
 
     def create_graph(self):
         self.graph = tf.Graph()
@@ -180,18 +363,36 @@ class SegmentationModel(object):
         with tf.name_scope("preds") as scope:
             self.preds = tf.to_int32(tf.argmax(self.logits, axis=-1), name=scope)
 
+        # PROBABILITIES - per pixel softmax over the classes
+        self.probs = tf.nn.softmax(self.logits, name="probs")
+
     def create_evaluation_metric_ops(self):
-        # EVALUATION METRIC - IoU
+        # EVALUATION METRIC - IoU is computed in numpy from the confusion
+        # matrices of the batches (see `iou_from_confusion_mtx()`)
         with tf.name_scope("evaluation") as scope:
-            # Define the evaluation metric and update operations
-            self.evaluation, self.update_evaluation_vars = tf.metrics.mean_iou(
+            # Confusion matrix of a single batch (no running variables), so
+            # it can be fetched cheaply alongside the training op.
+            self.batch_confusion_mtx = tf.confusion_matrix(
                 tf.reshape(self.Y, [-1]),
                 tf.reshape(self.preds, [-1]),
                 num_classes=self.n_classes,
-                name=scope)
-            # Isolate metric's running variables & create their initializer/reset op
-            evaluation_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope=scope)
-            self.reset_evaluation_vars = tf.variables_initializer(var_list=evaluation_vars)
+                dtype=tf.float64,
+                name="batch_confusion_mtx")
+
+            # IoU of each sample in the batch, computed the same way as
+            # `iou_from_confusion_mtx()` (nan if undefined), so the training
+            # steps do not have to fetch the predictions to get it.
+            labels_ohv = tf.one_hot(self.Y, self.n_classes)
+            preds_ohv = tf.one_hot(self.preds, self.n_classes)
+            intersection = tf.reduce_sum(labels_ohv*preds_ohv, axis=[1, 2])          # [batch, classes]
+            union = tf.reduce_sum(tf.maximum(labels_ohv, preds_ohv), axis=[1, 2])   # [batch, classes]
+            class_ious = intersection/union # nan for classes not present
+            if self.single_class_mode:
+                self.sample_ious = tf.identity(class_ious[:, 1], name="sample_ious")
+            else:
+                present = union > 0
+                n_present = tf.reduce_sum(tf.to_float(present), axis=-1)
+                self.sample_ious = tf.div(tf.reduce_sum(tf.where(present, class_ious, tf.zeros_like(class_ious)), axis=-1), n_present, name="sample_ious")
 
     def create_loss_ops(self):
         # LOSS - Sums all losses even Regularization losses automatically
@@ -201,13 +402,43 @@ class SegmentationModel(object):
             tf.losses.sparse_softmax_cross_entropy(labels=unrolled_labels, logits=unrolled_logits, reduction="weighted_sum_by_nonzero_weights")
             self.loss = tf.losses.get_total_loss()
 
+            # Loss of each sample in the batch (without regularization)
+            pixel_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=self.Y, logits=self.logits)
+            self.sample_losses = tf.reduce_mean(pixel_losses, axis=[1, 2], name="sample_losses")
+
     def create_optimization_ops(self):
         # OPTIMIZATION - Also updates batchnorm operations automatically
         with tf.variable_scope('opt') as scope:
             self.optimizer = tf.train.AdamOptimizer(self.alpha, name="optimizer")
             update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS) # allow batchnorm
             with tf.control_dependencies(update_ops):
-                self.train_op = self.optimizer.minimize(self.loss, name="train_op")
+                grads_and_vars = self.optimizer.compute_gradients(self.loss)
+                grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+                self.train_op = self.optimizer.apply_gradients(grads_and_vars, name="train_op")
+            self.grads_and_vars = grads_and_vars # See `create_grad_accumulation_ops()`
+
+    def create_grad_accumulation_ops(self):
+        """ Adds the ops to sum the gradients over several micro-batches, and
+            apply their mean as a single update, to the graph. Only called
+            by `train()` when `accum_steps > 1`, as the accumulators take as
+            much memory as all the trainable weights. They are local
+            variables, so they do not end up in the snapshots. """
+        if hasattr(self, "accumulate_grads_op"):
+            return
+        with self.graph.as_default():
+            with tf.variable_scope("opt/grad_accumulation"):
+                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS) # allow batchnorm
+                accumulators = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="accum_{}".format(i)) for i, (g, v) in enumerate(self.grads_and_vars)]
+                accum_count = tf.Variable(0.0, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="accum_count")
+                self.reset_grad_accumulators = tf.variables_initializer(accumulators+[accum_count], name="reset")
+
+                with tf.control_dependencies(update_ops):
+                    accumulate_ops = [a.assign_add(g) for a, (g, v) in zip(accumulators, self.grads_and_vars)]
+                    accumulate_ops.append(accum_count.assign_add(1.0))
+                    self.accumulate_grads_op = tf.group(*accumulate_ops, name="accumulate")
+
+                mean_grads = [(a/tf.maximum(accum_count, 1.0), v) for a, (g, v) in zip(accumulators, self.grads_and_vars)]
+                self.apply_accumulated_grads_op = self.optimizer.apply_gradients(mean_grads, name="apply_accumulated")
 
     def create_tensorboard_ops(self):
         # # TENSORBOARD
@@ -216,7 +447,7 @@ class SegmentationModel(object):
 
         # TENSORBOARD - To visialize the architecture
         with tf.variable_scope('tensorboard') as scope:
-            self.summary_writer = tf.summary.FileWriter(self.tensorboard_dir, graph=self.graph)
+            self.summary_writer = None if self.read_only else tf.summary.FileWriter(self.tensorboard_dir, graph=self.graph)
             self.dummy_summary = tf.summary.scalar(name="dummy", tensor=1)
             #self.summary_op = tf.summary.merge_all()
 
@@ -240,21 +471,91 @@ class SegmentationModel(object):
                 os.makedirs(dir)
 
     def initialize_evals_dict(self, keys):
-        """ If evals file exists, load it, otherwise create one from scratch.
+        """ Rebuilds the evals dict from the epoch log. If there is no epoch
+            log, but there is an evals pickle file from an older version of
+            the model (see `legacy_epoch_records()`), it gets migrated to an
+            epoch log first. Otherwise it creates one from scratch.
             You should specify the keys you want to use in the dict."""
+        self.evals = {key: [] for key in keys}
+        self.evals["global_epoch"] = 0
+        if not os.path.exists(self.epochs_file) and not self.read_only:
+            records = self.legacy_epoch_records()
+            if records is not None:
+                print("Migrating {} previously saved epoch records to: \n- {}".format(len(records), self.epochs_file))
+                self.create_epochs_file(records)
+
+        if os.path.exists(self.epochs_file):
+            print("Loading previosuly saved epoch log from: \n- ", self.epochs_file)
+            records, _ = jsonl2dicts(self.epochs_file)
+            for record in records:
+                for key in self.evals:
+                    if key in record and isinstance(self.evals[key], list):
+                        self.evals[key].append(record[key])
+                self.evals["global_epoch"] = record["global_epoch"]
+                self.evals["global_step"] = record.get("global_step", 0)
+
+    def legacy_epoch_records(self):
+        """ Returns the epoch records saved by older versions of the model in
+            an evals pickle file, or None if there is none. """
         if os.path.exists(self.evals_file):
-            print("Loading previosuly saved evals file from: \n- ", self.evals_file)
-            with open(self.evals_file, mode = "rb") as fileObj:
-                self.evals = pickle.load(fileObj)
-        else:
-            self.evals = {key: [] for key in keys}
-            self.evals["global_epoch"] = 0
-
-    def save_evals_dict(self):
-        """ Save evals dict to a picle file in models root directory """
-        with open(self.evals_file, mode="wb") as fileObj:
-            self.evals["global_epoch"] = self.global_epoch
-            pickle.dump(self.evals, fileObj, protocol=2) #py2.7 & 3.x compatible
+            evals = pickle2obj(self.evals_file)
+            series = {key: val for key, val in evals.items() if isinstance(val, list)}
+            n_epochs = max([len(val) for val in series.values()] + [0])
+            first_epoch = evals.get("global_epoch", n_epochs) - n_epochs + 1
+            records = []
+            for i in range(n_epochs):
+                record = {"type": "epoch", "time": time.time(), "global_step": evals.get("global_step", 0)}
+                record.update({key: val[i] for key, val in series.items() if i < len(val)})
+                record["global_epoch"] = first_epoch + i
+                records.append(record)
+            return records
+        return None
+
+    def create_epochs_file(self, records):
+        """ Creates the epoch log with the given records, unless it already
+            exists. The log is written to a temporary file first, and only
+            linked into place if no other process created it in the
+            meantime, so that records never get written twice. """
+        fd, tmp_file = tempfile.mkstemp(dir=self.model_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            for record in records:
+                dict2jsonl(record, file=tmp_file)
+            try:
+                os.link(tmp_file, self.epochs_file) # fails if it exists
+            except OSError as e:
+                if e.errno != errno.EEXIST and not os.path.exists(self.epochs_file):
+                    os.rename(tmp_file, self.epochs_file) # no hard link support
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def log_metrics(self, record_type, **kwargs):
+        """ Appends a single record to the metrics log. The log is append
+            only, so the cost of logging does not grow with training time.
+            Epoch records go to their own log (`epochs_file`), so the evals
+            can be rebuilt without reading all the step records.
+            eg: log_metrics("step", loss=0.341, step_time=0.2)
+        """
+        record = {"type": record_type, "time": time.time(), "global_epoch": self.global_epoch, "global_step": self.global_step}
+        record.update(kwargs)
+        dict2jsonl(record, file=self.epochs_file if record_type == "epoch" else self.metrics_file)
+
+    def write_summaries(self, scalars, step=None):
+        """ Writes a dictionary of {tag: value} scalars to tensorboard, at
+            `step` (defaults to the global step) """
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=float(value)) for tag, value in scalars.items()])
+        self.summary_writer.add_summary(summary, global_step=self.global_step if step is None else step)
+
+    def write_step_summaries(self, step_stats, alpha):
+        """ Given the sums of the timings, loss, num samples and num steps
+            over the last few steps, it writes their means to tensorboard """
+        n_steps = step_stats["n_steps"]
+        scalars = {"time/{}_ms".format(key.replace("_time", "")): 1000*step_stats[key]/n_steps for key in ["fetch_time", "augment_time", "feed_time", "run_time", "step_time"]}
+        scalars["train/samples_per_sec"] = step_stats["n_samples"]/max(step_stats["step_time"], 1e-9)
+        scalars["train/loss"] = step_stats["loss"]/n_steps
+        scalars["train/learning_rate"] = alpha
+        self.write_summaries(scalars)
 
     def initialize_vars(self, session, best=False):
         """ Override this if you set up custom savers """
@@ -295,26 +596,106 @@ class SegmentationModel(object):
             os.makedirs(os.path.dirname(file))
         self.saver.save(session, file)
 
+    def export_frozen_graph(self, session, file):
+        """ Given an open session with the weights loaded, it saves a pruned
+            GraphDef (*.pb) file to `file`, with the weights frozen into
+            constants. It only contains the ops needed to go from the
+            `inputs/X` placeholder to `preds` and `probs` (and the `inputs/is_training`
+            placeholder, so it is always present). Load it with
+            `FrozenSegmentationModel`.
+        """
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session,
+            self.graph.as_graph_def(),
+            output_node_names=["preds", "probs", "inputs/is_training"])
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=["inputs/X", "inputs/is_training", "preds", "probs"])
+        maybe_make_pardir(file)
+        with tf.gfile.GFile(file, "wb") as file_obj:
+            file_obj.write(graph_def.SerializeToString())
+        print("Saved frozen graph with {} nodes to: \n- {}".format(len(graph_def.node), file))
+
     def shuffle_train_data(self, data):
         n_samples = len(data["Y_train"])
         permutation = list(np.random.permutation(n_samples))
         data["X_train"] = data["X_train"][permutation]
         data["Y_train"] = data["Y_train"][permutation]
+        # Keep track of the order relative to the data that was passed in
+        if self.train_order is not None:
+            self.train_order = self.train_order[permutation]
         return data
 
-    def get_batch(self, i, batch_size, X, Y=None):
-        """ Get the ith batch from the data."""
-        X_batch = X[batch_size*i: batch_size*(i+1)]
-        # Handle dynamic loading option
-        if self.dynamic:
-            X_batch = load_batch_of_images(X_batch, img_shape=self.img_shape)
-
-        # Batch of labels if needed
-        if Y is not None:
-            Y_batch = Y[batch_size*i: batch_size*(i+1)]
-            return X_batch, Y_batch
-        else:
-            return X_batch
+    def save_step_checkpoint_in_session(self, session, step, batch_size, accum_steps, running_stats=None, difficulty_index=None):
+        """ Saves a mid-epoch checkpoint. Along with the weights it stores
+            everything needed to resume training from the next step with
+            the exact same data order and random state.
+
+            step: (int) Index of the next batch to process in current epoch
+            batch_size, accum_steps: The settings `step` is counted in. The
+                checkpoint can only be resumed with the same settings.
+            running_stats: (dict or None) Running train statistics of the
+                steps done so far in the epoch, to carry on from on resume.
+            difficulty_index: (DifficultyIndex or None) Including the updates
+                of the steps done so far in the epoch.
+        """
+        self.save_snapshot_in_session(session, self.step_snapshot_file)
+        state = {
+            "global_epoch": self.global_epoch, # The epoch in progress
+            "global_step": self.global_step,
+            "step": step,
+            "batch_size": batch_size,
+            "accum_steps": accum_steps,
+            "n_samples": len(self.train_order),
+            "train_order": self.train_order,
+            "batch_order": self.batch_order,
+            "running_stats": running_stats,
+            "difficulty_index": difficulty_index,
+            "np_rng_state": np.random.get_state(),
+            "py_rng_state": random.getstate(),
+            }
+        obj2pickle(state, self.step_state_file)
+
+    def load_step_state(self, n_samples, batch_size, accum_steps):
+        """ Returns the state saved by the last mid-epoch checkpoint, or None
+            if there is no checkpoint for the epoch currently in progress, or
+            it was saved with a different training set size, `batch_size` or
+            `accum_steps` (its step would point to the wrong samples).
+        """
+        if not os.path.exists(self.step_state_file):
+            return None
+        state = pickle2obj(self.step_state_file)
+        settings = (state["global_epoch"], state["n_samples"], state.get("batch_size"), state.get("accum_steps"))
+        if settings != (self.global_epoch + 1, n_samples, batch_size, accum_steps):
+            print("Ignoring stale mid-epoch checkpoint at: \n- ", self.step_state_file)
+            return None
+        return state
+
+    def allocator_stats_in_session(self, session):
+        """ Returns a dictionary of the tensorflow allocator stats (bytes in
+            use, peak bytes in use, and the limit) of the default device,
+            or the error if they are not available on that device """
+        if not hasattr(self, "allocator_stats_ops"):
+            from tensorflow.contrib.memory_stats import BytesInUse, MaxBytesInUse, BytesLimit
+            with self.graph.as_default():
+                with tf.variable_scope("memory_stats"):
+                    self.allocator_stats_ops = {"bytes_in_use": BytesInUse(), "max_bytes_in_use": MaxBytesInUse(), "bytes_limit": BytesLimit()}
+        try:
+            return {key: int(value) for key, value in session.run(self.allocator_stats_ops).items()}
+        except tf.errors.OpError as e:
+            return {"error": e.message.split("\n")[0]}
+
+    def load_difficulty_index(self, n_samples):
+        """ Returns the per-sample difficulty index saved by previous
+            training, or a new one if there is none for this training set """
+        if os.path.exists(self.difficulty_file):
+            index = pickle2obj(self.difficulty_file)
+            if index.n_samples == n_samples:
+                return index
+        return DifficultyIndex(n_samples)
+
+    def clear_step_state(self):
+        """ Removes mid-epoch state once the epoch it belongs to is done """
+        if os.path.exists(self.step_state_file):
+            os.remove(self.step_state_file)
 
     def update_status_file(self, status):
         str2file(status, file=self.train_status_file)
@@ -327,78 +708,295 @@ class SegmentationModel(object):
         for key in kwargs:
             self.evals[key].append(kwargs[key])
 
-    def create_session(self):
-        """ Creates and returns a session. Be careful to close it
-            Ideally use it as follows:
-
-            with model.create_session() as session:
-                # Do something with the session here
-                ...
+    def save_model_info(self):
+        """ Saves the architecture and input settings of the model to the
+            model directory, so tools can rebuild it from just the directory """
+        info = {"arc": type(self).__name__, "img_shape": list(self.img_shape), "n_classes": 1 if self.single_class_mode else self.n_classes}
+        with open(self.info_file, mode="w") as fileObj:
+            json.dump(info, fileObj)
+
+    def train(self, data, n_epochs, alpha=0.001, dropout=0.0, batch_size=32, print_every=10, l2=None, augmentation_func=None, viz_every=10, accum_steps=1, patience=None, min_delta=0.0, time_budget=None, checkpoint_every_steps=None, checkpoint_every_mins=None, train_eval_mode="subset", train_eval_size=1000, sampling="uniform", sampling_temperature=1.0, sampling_floor=0.1, profile_steps=None, summary_every=10, memory_tracker=None):
+        """Trains the model, for n_epochs given a dictionary of data
+
+           accum_steps: (int) Number of micro-batches of `batch_size` whose
+                        gradients get accumulated before a single update is
+                        applied. The effective batch size is
+                        `batch_size*accum_steps`, while memory usage stays
+                        that of a single `batch_size` batch.
+           patience:    (int or None) Stop early if `best_evals_metric` has
+                        not improved by more than `min_delta` for this many
+                        epochs in a row. None disables early stopping.
+           min_delta:   (float) Minimum increase of `best_evals_metric`
+                        over the best value so far that counts as an
+                        improvement.
+           time_budget: (float or None) Wall-clock budget in seconds. A new
+                        epoch is only started if, based on the mean of the
+                        epoch times measured so far, it is expected to
+                        finish within the budget.
+           checkpoint_every_steps: (int or None) Save a resumable mid-epoch
+                        checkpoint every this many steps.
+           checkpoint_every_mins: (float or None) Save a resumable mid-epoch
+                        checkpoint every this many minutes.
+
+           train_eval_mode: (str) How to compute the train IoU and loss
+                        reported after each epoch.
+                        - "subset":  Extra evaluation pass over a fixed
+                                     subset of `train_eval_size` training
+                                     samples (the same ones every epoch).
+                        - "running": Accumulate the confusion matrix and loss
+                                     from the forward passes already made by
+                                     the training steps of that epoch. No
+                                     extra pass is needed, but note that these
+                                     come from augmented data, with the model
+                                     in training mode, while weights change.
+                                     They are saved with mid-epoch
+                                     checkpoints, so a resumed epoch still
+                                     reports the stats of all its steps.
+           train_eval_size: (int) Num samples used by "subset" mode.
+
+           sampling:    (str) How the samples of each epoch are chosen.
+                        The recent loss and IoU of every training sample is
+                        always recorded in a `DifficultyIndex`, saved to
+                        `difficulty_file` after each epoch, and with
+                        mid-epoch checkpoints.
+                        - "uniform": Every sample once per epoch.
+                        - "hard":    Draw n_samples with replacement, with
+                                     probability weighted by how hard the
+                                     sample was recently.
+           sampling_temperature: (float) Lower values focus more on the
+                        hardest samples, higher ones tend towards uniform.
+           sampling_floor: (float) Fraction of the probability mass that is
+                        spread uniformly over all samples, so easy samples
+                        still get visited.
+           profile_steps: (list of ints or None) Global steps to capture a
+                        full trace of. See `run_in_session()`.
+           summary_every: (int or None) Write the mean time spent fetching
+                        data, augmenting, feeding and in `sess.run()`, along
+                        with samples/sec, loss and learning rate of the last
+                        `summary_every` steps to tensorboard. None disables.
+           memory_tracker: (MemoryTracker or None) If given, the memory of
+                        the data arrays, the peak RSS of each epoch and
+                        evaluation phase, and tensorflow allocator stats
+                        are recorded, and the report is saved to
+                        `memory_report_file` after each epoch.
+
+           If a mid-epoch checkpoint exists for the epoch that was in
+           progress, training resumes from the step after it, with the same
+           data order and numpy/python random states.
         """
-        session = tf.Session(graph=self.graph)
-        return session
-
-    def train(self, data, n_epochs, alpha=0.001, dropout=0.0, batch_size=32, print_every=10, l2=None, augmentation_func=None, viz_every=10):
-        """Trains the model, for n_epochs given a dictionary of data"""
+        assert not self.read_only, "A read only model can not be trained"
+        assert accum_steps >= 1, "accum_steps must be a positive integer"
+        assert train_eval_mode in ["subset", "running"], "train_eval_mode must be one of 'subset', 'running'"
+        assert sampling in ["uniform", "hard"], "sampling must be one of 'uniform', 'hard'"
         n_samples = len(data["X_train"])               # Num training samples
         n_batches = int(np.ceil(n_samples/batch_size)) # Num batches per epoch
         print("DEBUG - ", "using aug func" if augmentation_func is not None else "NOT using aug func")
+        if accum_steps > 1:
+            print("ACCUMULATING GRADIENTS OVER {} STEPS (EFFECTIVE BATCH SIZE: {})".format(accum_steps, batch_size*accum_steps))
+            self.create_grad_accumulation_ops()
+        self.save_model_info()
+        difficulty_index = self.load_difficulty_index(n_samples)
+        memory_tracker = memory_tracker if memory_tracker is not None else MemoryTracker(enabled=False)
         with tf.Session(graph=self.graph) as sess:
             self.initialize_vars(sess)
+            if accum_steps > 1:
+                sess.run(self.reset_grad_accumulators)
+
+            # RESUME FROM A MID-EPOCH CHECKPOINT
+            self.train_order = np.arange(n_samples)
+            start_step = 0
+            resumed_running_stats = None
+            resume_state = self.load_step_state(n_samples, batch_size=batch_size, accum_steps=accum_steps)
+            if resume_state is not None:
+                print("Resuming from mid-epoch checkpoint (GLOBAL_EPOCH: {}, STEP: {})".format(resume_state["global_epoch"], resume_state["step"]))
+                self.saver.restore(sess, self.step_snapshot_file)
+                self.global_epoch = resume_state["global_epoch"] - 1
+                self.global_step = resume_state["global_step"]
+                self.train_order = resume_state["train_order"]
+                self.batch_order = resume_state.get("batch_order")
+                data["X_train"] = data["X_train"][self.train_order]
+                data["Y_train"] = data["Y_train"][self.train_order]
+                np.random.set_state(resume_state["np_rng_state"])
+                random.setstate(resume_state["py_rng_state"])
+                start_step = resume_state["step"]
+                resumed_running_stats = resume_state.get("running_stats")
+                if resume_state.get("difficulty_index") is not None:
+                    difficulty_index = resume_state["difficulty_index"]
+
             t0 = time.time()
+            t_last_checkpoint = t0
+            history = self.evals[self.best_evals_metric]
+            best_score = max(history) if len(history) > 0 else None
+            epoch_times = []
+            n_stale_epochs = 0
+            stop_reason = None
 
             try:
                 self.update_status_file("training")
                 for epoch in range(1, n_epochs+1):
+                    # Stop if the next epoch is not expected to fit the budget
+                    if time_budget is not None and len(epoch_times) > 0:
+                        if (time.time()-t0) + np.mean(epoch_times) > time_budget:
+                            stop_reason = "time budget of {} would be exceeded".format(pretty_time(time_budget))
+                            break
+
+                    t_epoch = time.time()
                     self.global_epoch += 1
+                    memory_tracker.start_phase("epoch_{}".format(self.global_epoch))
                     print("="*70, "\nEPOCH {}/{} (GLOBAL_EPOCH: {})        ELAPSED TIME: {}".format(epoch, n_epochs, self.global_epoch, pretty_time(time.time()-t0)),"\n"+("="*70))
 
-                    # Shuffle the data
-                    data = self.shuffle_train_data(data)
+                    # Shuffle the data (unless resuming part way through epoch)
+                    if start_step == 0:
+                        data = self.shuffle_train_data(data)
+                    if sampling == "uniform":
+                        self.batch_order = None
+                    elif start_step == 0 or self.batch_order is None:
+                        self.batch_order = difficulty_index.sample_order(temperature=sampling_temperature, floor=sampling_floor)
+                    positions = np.argsort(self.train_order) # position of each sample id in data
+
+                    memory_tracker.record_arrays(data)
+
+                    # Running statistics of the training steps of this epoch
+                    # (carried on from the checkpoint if resuming part way)
+                    if start_step > 0 and resumed_running_stats is not None:
+                        running_stats = resumed_running_stats
+                    else:
+                        running_stats = {"confusion_mtx": np.zeros([self.n_classes, self.n_classes], dtype=np.float64), "loss": 0.0, "n_samples": 0}
 
                     # Iterate through each mini-batch
-                    for i in range(n_batches):
-                        X_batch, Y_batch = self.get_batch(i, X=data["X_train"], Y=data["Y_train"], batch_size=batch_size)
+                    accum_losses = []
+                    loss = np.nan
+                    step_stats = {}
+                    for i in range(start_step, n_batches):
+                        t_step = time.time()
+                        if sampling == "hard":
+                            ids = self.batch_order[batch_size*i: batch_size*(i+1)]
+                            idx = positions[ids]
+                            X_batch, Y_batch = self.get_batch(0, X=data["X_train"][idx], Y=data["Y_train"][idx], batch_size=batch_size)
+                        else:
+                            ids = self.train_order[batch_size*i: batch_size*(i+1)]
+                            X_batch, Y_batch = self.get_batch(i, X=data["X_train"], Y=data["Y_train"], batch_size=batch_size)
+                        t_fetch = time.time()
                         if augmentation_func is not None:
                             X_batch, Y_batch = augmentation_func(X_batch, Y_batch)
+                        t_augment = time.time()
 
                         # TRAIN
+                        # (convert to the placeholder dtypes here, so the
+                        # cost of feeding shows up separately from sess.run)
+                        X_batch = np.asarray(X_batch, dtype=np.float32)
+                        Y_batch = np.asarray(Y_batch, dtype=np.int32)
                         feed_dict = {self.X:X_batch, self.Y:Y_batch, self.alpha:alpha, self.is_training:True, self.dropout: dropout}
-                        loss, _ = sess.run([self.loss, self.train_op], feed_dict=feed_dict)
+                        t_feed = time.time()
+                        trace_tag = "train_step_{:07d}".format(self.global_step+1) if profile_steps is not None and (self.global_step+1) in profile_steps else None
+                        if accum_steps == 1:
+                            loss, batch_confusion_mtx, sample_losses, sample_ious, _ = self.run_in_session(sess, [self.loss, self.batch_confusion_mtx, self.sample_losses, self.sample_ious, self.train_op], feed_dict=feed_dict, trace_tag=trace_tag)
+                            micro_loss = loss
+                        else:
+                            # Accumulate gradients, and only apply them once
+                            # every `accum_steps` micro-batches (or at the
+                            # end of the epoch for any remaining ones)
+                            micro_loss, batch_confusion_mtx, sample_losses, sample_ious, _ = self.run_in_session(sess, [self.loss, self.batch_confusion_mtx, self.sample_losses, self.sample_ious, self.accumulate_grads_op], feed_dict=feed_dict, trace_tag=trace_tag)
+                            accum_losses.append(micro_loss)
+                            if len(accum_losses) == accum_steps or (i+1) == n_batches:
+                                sess.run(self.apply_accumulated_grads_op, feed_dict={self.alpha:alpha})
+                                sess.run(self.reset_grad_accumulators)
+                                loss = np.mean(accum_losses)
+                                accum_losses = []
+                        t_run = time.time()
+                        self.global_step += 1
+                        running_stats["confusion_mtx"] += batch_confusion_mtx
+                        running_stats["loss"] += micro_loss
+                        running_stats["n_samples"] += len(X_batch)
+                        difficulty_index.update(ids, sample_losses, sample_ious)
+                        step_time = time.time()-t_step
+                        timings = {"fetch_time": t_fetch-t_step, "augment_time": t_augment-t_fetch, "feed_time": t_feed-t_augment, "run_time": t_run-t_feed, "step_time": step_time}
+                        self.log_metrics("step", loss=micro_loss, batch_size=len(X_batch), **timings)
+
+                        # Tensorboard summaries of the mean over the last few steps
+                        for key, value in list(timings.items()) + [("loss", micro_loss), ("n_samples", len(X_batch)), ("n_steps", 1)]:
+                            step_stats[key] = step_stats.get(key, 0) + value
+                        if summary_every is not None and self.global_step%summary_every==0:
+                            self.write_step_summaries(step_stats, alpha=alpha)
+                            step_stats = {}
 
                         # Print feedback every so often
                         if print_every is not None and (i+1)%print_every==0:
-                            print("{} {: 5d} Batch_loss: {}".format(pretty_time(time.time()-t0), i, loss))
+                            # Before the first update of the epoch, use the
+                            # mean loss of the micro-batches accumulated so far
+                            print_loss = np.mean(accum_losses) if np.isnan(loss) and len(accum_losses) > 0 else loss
+                            print("{} {: 5d} Batch_loss: {}".format(pretty_time(time.time()-t0), i, print_loss))
+
+                        # Mid-epoch checkpoint (only between weight updates)
+                        due_by_steps = checkpoint_every_steps is not None and self.global_step%checkpoint_every_steps==0
+                        due_by_time = checkpoint_every_mins is not None and (time.time()-t_last_checkpoint) >= checkpoint_every_mins*60
+                        if (due_by_steps or due_by_time) and len(accum_losses)==0 and (i+1) < n_batches:
+                            self.save_step_checkpoint_in_session(sess, step=i+1, batch_size=batch_size, accum_steps=accum_steps, running_stats=running_stats, difficulty_index=difficulty_index)
+                            t_last_checkpoint = time.time()
+                    start_step = 0
 
                     # Save parameters after each epoch
                     self.save_snapshot_in_session(sess, self.snapshot_file)
 
                     # Evaluate on full train and validation sets after each epoch
-                    train_iou, train_loss = self.evaluate_in_session(data["X_train"][:1000], data["Y_train"][:1000], sess)
+                    t_eval = time.time()
+                    memory_tracker.start_phase("eval_{}".format(self.global_epoch))
+                    if train_eval_mode == "running":
+                        # Same normalization as `evaluate_in_session()`
+                        train_iou = self.iou_from_confusion_mtx(running_stats["confusion_mtx"])
+                        train_loss = running_stats["loss"]/float(max(running_stats["n_samples"], 1))
+                    else:
+                        # The same samples every epoch (the first ones of the
+                        # data as it was passed in), wherever the shuffle put them
+                        subset = np.sort(positions[:train_eval_size])
+                        train_iou, train_loss = self.evaluate_in_session(data["X_train"][subset], data["Y_train"][subset], sess)
                     valid_iou, valid_loss = self.evaluate_in_session(data["X_valid"], data["Y_valid"], sess)
                     self.update_evals_dict(train_iou=train_iou, train_loss=train_loss, valid_iou=valid_iou, valid_loss=valid_loss)
-                    self.save_evals_dict()
+                    self.log_metrics("epoch", train_iou=train_iou, train_loss=train_loss, valid_iou=valid_iou, valid_loss=valid_loss, epoch_time=time.time()-t_epoch, eval_time=time.time()-t_eval)
+                    self.write_summaries({"epoch/train_iou": train_iou, "epoch/valid_iou": valid_iou, "epoch/train_loss": train_loss, "epoch/valid_loss": valid_loss, "epoch/epoch_time": time.time()-t_epoch})
+                    self.summary_writer.flush()
+                    self.clear_step_state()
+                    obj2pickle(difficulty_index, self.difficulty_file)
+                    memory_tracker.end_phase()
+                    if memory_tracker.enabled:
+                        memory_tracker.record_allocator_stats(self.allocator_stats_in_session(sess))
+                        memory_tracker.save(self.memory_report_file)
 
                     # If its the best model so far, save best snapshot
-                    is_best_so_far = self.evals[self.best_evals_metric][-1] >= max(self.evals[self.best_evals_metric])
+                    score = self.evals[self.best_evals_metric][-1]
+                    prev_best_score = best_score
+                    is_best_so_far = best_score is None or score >= best_score
                     if is_best_so_far:
+                        best_score = score
                         self.save_snapshot_in_session(sess, self.best_snapshot_file)
 
                     # Print evaluations (with asterix at end if it is best model so far)
                     s = "TR IOU: {: 3.3f} VA IOU: {: 3.3f} TR LOSS: {: 3.5f} VA LOSS: {: 3.5f} {}\n"
                     print(s.format(train_iou, valid_iou, train_loss, valid_loss, "*" if is_best_so_far else ""))
 
-                    # # TRAIN CURVES
-                    train_curves(train=self.evals["train_iou"], valid=self.evals["valid_iou"], saveto=os.path.join(self.model_dir, "iou.png"), title="IoU over time", ylab="IoU", legend_pos="lower right")
-                    train_curves(train=self.evals["train_loss"], valid=self.evals["valid_loss"], saveto=os.path.join(self.model_dir, "loss.png"), title="Loss over time", ylab="loss", legend_pos="upper right")
-
-                    # VISUALIZE PREDICTIONS - once every so many epochs
+                    # TRAIN CURVES AND PREDICTIONS - once every so many epochs
                     if self.global_epoch%viz_every==0:
+                        self.plot_train_curves()
                         self.visualise_semgmentations(data=data, session=sess)
 
 
-                    str2file(str(max(self.evals[self.best_evals_metric])), file=self.best_score_file)
-                self.update_status_file("done")
+                    str2file(str(best_score), file=self.best_score_file)
+                    epoch_times.append(time.time()-t_epoch)
+
+                    # EARLY STOPPING - if the metric has plateaued
+                    if patience is not None:
+                        improved = prev_best_score is None or score > prev_best_score + min_delta
+                        n_stale_epochs = 0 if improved else n_stale_epochs + 1
+                        if n_stale_epochs >= patience:
+                            stop_reason = "{} did not improve by more than {} for {} epochs".format(self.best_evals_metric, min_delta, n_stale_epochs)
+                            break
+
+                self.plot_train_curves()
+                if stop_reason is not None:
+                    print("STOPPING EARLY: ", stop_reason)
+                    self.update_status_file("stopped early: "+stop_reason)
+                else:
+                    self.update_status_file("done")
                 print("DONE in ", pretty_time(time.time()-t0))
 
             except KeyboardInterrupt as e:
@@ -410,86 +1008,109 @@ class SegmentationModel(object):
                 self.update_status_file("crashed")
                 raise
 
+    def plot_train_curves(self):
+        """ Saves plots of the IoU and loss over all epochs to model dir """
+        train_curves(train=self.evals["train_iou"], valid=self.evals["valid_iou"], saveto=os.path.join(self.model_dir, "iou.png"), title="IoU over time", ylab="IoU", legend_pos="lower right")
+        train_curves(train=self.evals["train_loss"], valid=self.evals["valid_loss"], saveto=os.path.join(self.model_dir, "loss.png"), title="Loss over time", ylab="loss", legend_pos="upper right")
+
     def predict(self, X, batch_size=32, verbose=True, best=True, session=None):
+        """ Makes predictions on X. If no session is given, it uses a warm
+            session from the process wide `session_registry`, so the
+            snapshot is only restored the first time (or once it changes).
+        """
         if session is None:
-            with tf.Session(graph=self.graph) as sess:
-                self.initialize_vars(sess, best=best)
-                return self.predict_in_session(X, session=sess, batch_size=batch_size, verbose=verbose, best=best)
-        else:
-            return self.predict_in_session(X, session=session, batch_size=batch_size, verbose=verbose)
+            session = session_registry.get_session(self, best=best)
+        return self.predict_in_session(X, session=session, batch_size=batch_size, verbose=verbose)
 
-    def predict_in_session(self, X, session, batch_size=32, verbose=True):
-        """Given input X make a forward pass of the model to get predictions"""
-        # Dimensions
-        n_samples = X.shape[0]
-        n_batches = int(np.ceil(n_samples/batch_size))
-        preds = np.zeros([n_samples, self.img_height, self.img_width], dtype=np.uint8)
-        if verbose:
-            print("MAKING PREDICTIONS")
-            percent_interval=10
-            print_every = n_batches/percent_interval
-            percent = 0
+    def predict_cached(self, X, batch_size=32, best=True, kind="preds"):
+        """ Like `predict()`, but reuses predictions stored in the model's
+            prediction cache if the snapshot and X have not changed since
+            they were made.
 
-        # MAKE PREDICTIONS ON MINI BATCHES
-        for i in range(n_batches):
-            X_batch = self.get_batch(i, batch_size=batch_size, X=X)
-            feed_dict = {self.X:X_batch, self.is_training:False}
-            batch_preds = session.run(self.preds, feed_dict=feed_dict)
-            preds[batch_size*i: batch_size*(i+1)] = batch_preds.squeeze()
+            kind: (str) "preds" for the predicted class of each pixel, or
+                  "probs" for the probability of the road class.
+        """
+        snapshot_file = self.best_snapshot_file if best else self.snapshot_file
+        return self.predict_cached_in_session(X, snapshot_file, session=None, batch_size=batch_size, kind=kind, best=best)
 
-            if verbose and (i+1)%print_every == 0:
-                percent += percent_interval
-                print("- {} %".format(percent))
+    def predict_cached_in_session(self, X, snapshot_file, session, batch_size=32, kind="preds", best=True):
+        """ Like `predict_cached()`, for a session that holds the weights
+            saved in `snapshot_file`. If session is None, a warm session is
+            only taken from `session_registry` if the cache misses.
 
-        return preds
+            Returns uint8 preds, or float32 probs, whether they come from the
+            cache or not.
+        """
+        dtype = np.float32 if kind == "probs" else np.uint8
+        cached = self.prediction_cache.get(snapshot_file, X, kind=kind)
+        if cached is not None:
+            return np.asarray(cached, dtype=dtype)
 
-    def evaluate(self, X, Y, batch_size=32, best=False):
-        """Given input X, and Labels Y, evaluate the accuracy of the model"""
-        with tf.Session(graph=self.graph) as sess:
-            self.initialize_vars(sess, best=best)
-            return self.evaluate_in_session(X,Y, sess, batch_size=batch_size)
+        if session is None:
+            session = session_registry.get_session(self, best=best)
+        if kind == "probs":
+            preds = self.predict_probs_in_session(X, session=session, batch_size=batch_size)[..., 1]
+        else:
+            preds = self.predict_in_session(X, session=session, batch_size=batch_size, verbose=False)
+        self.prediction_cache.put(snapshot_file, X, preds, kind=kind)
+        return np.asarray(preds, dtype=dtype)
 
-    def evaluate_in_session(self, X, Y, session, batch_size=32):
+    def evaluate(self, X, Y, batch_size=32, best=False):
+        """Given input X, and Labels Y, evaluate the accuracy of the model.
+           Uses a warm session from the process wide `session_registry`."""
+        sess = session_registry.get_session(self, best=best)
+        return self.evaluate_in_session(X,Y, sess, batch_size=batch_size)
+
+    def evaluate_cached(self, X, Y, batch_size=32, best=False):
+        """ Returns the scores (see `metrics.scores_from_confusion()`) of the
+            predictions on X, reusing cached predictions when possible.
+            NOTE: The loss is not included, as it needs a forward pass. """
+        preds = self.predict_cached(X, batch_size=batch_size, best=best)
+        return scores_from_confusion(confusion_matrix(Y, preds, n_classes=self.n_classes))
+
+    def close_sessions(self):
+        """ Closes the warm sessions of this model in the `session_registry` """
+        session_registry.close(self)
+
+    def evaluate_in_session(self, X, Y, session, batch_size=32, profile_batches=None):
         """Evaluate the model on some data (does it in batches).
            Returns a tuple (avg_loss, iou_score)
+
+           profile_batches: (list of ints or None) Indices of the batches to
+                capture a full trace of. See `run_in_session()`.
         """
         # Iterate through each mini-batch
         total_loss = 0
         n_samples = len(Y)
         n_batches = int(np.ceil(n_samples/batch_size)) # Num batches needed
-
-        # Reset the running variables for evaluation metric
-        session.run(self.reset_evaluation_vars)
+        confusion_mtx = np.zeros([self.n_classes, self.n_classes], dtype=np.float64)
 
         for i in range(n_batches):
             X_batch, Y_batch = self.get_batch(i, batch_size=batch_size, X=X, Y=Y)
             feed_dict = {self.X:X_batch, self.Y:Y_batch, self.is_training:False}
 
-            loss, preds, confusion_mtx = session.run([self.loss, self.preds, self.update_evaluation_vars], feed_dict=feed_dict)
+            trace_tag = "evaluate_batch_{:05d}".format(i) if profile_batches is not None and i in profile_batches else None
+            loss, batch_confusion_mtx = self.run_in_session(session, [self.loss, self.batch_confusion_mtx], feed_dict=feed_dict, trace_tag=trace_tag)
             total_loss += loss
+            confusion_mtx += batch_confusion_mtx
 
-        if self.single_class_mode:
-            # IoU for single-class segmentation
-            class_id = 1    # the class of interest
-            true_positives = confusion_mtx[class_id,class_id]
-            false_positives = np.delete(confusion_mtx[:,class_id], class_id).sum()
-            false_negatives = np.delete(confusion_mtx[class_id], class_id).sum()
-            score = true_positives / (true_positives + false_positives + false_negatives)
-        else:
-            # IoU for multi-class segmentation
-            score = session.run(self.evaluation)
-
+        score = self.iou_from_confusion_mtx(confusion_mtx)
         avg_loss = total_loss/float(n_samples)
         return score, avg_loss
 
-    def visualise_semgmentations(self, data, session):
+    def visualise_semgmentations(self, data, session, snapshot_file=None):
+        """ Saves grids of predictions on samples of the train and validation
+            data. If the weights in the session are those saved in
+            `snapshot_file` (defaults to the latest snapshot), predictions
+            are reused from the prediction cache when possible. """
         # TODO: URGENT: Make this function dynamic data loading friendly
+        snapshot_file = self.snapshot_file if snapshot_file is None else snapshot_file
         viz_rows, viz_cols = [9, 3]
         n_viz = viz_rows * viz_cols
         viz_img_template = os.path.join(self.model_dir, "samples", "{}", "epoch_{:07d}.jpg")
 
         # On train data
-        preds = self.predict_in_session(data["X_train_viz"][:n_viz], session=session, batch_size=self.batch_size, verbose=False)
+        preds = self.predict_cached_in_session(data["X_train_viz"][:n_viz], snapshot_file, session=session, batch_size=self.batch_size)
         vizseg(
             img=batch2grid(data["X_train_viz"][:n_viz], viz_rows, viz_cols),
             label=batch2grid(data["Y_train_viz"][:n_viz], viz_rows, viz_cols),
@@ -498,7 +1119,7 @@ class SegmentationModel(object):
             )
 
         # On validation Data
-        preds = self.predict_in_session(data["X_valid"][:n_viz], session=session, batch_size=self.batch_size, verbose=False)
+        preds = self.predict_cached_in_session(data["X_valid"][:n_viz], snapshot_file, session=session, batch_size=self.batch_size)
         vizseg(
             img=batch2grid(data["X_valid"][:n_viz], viz_rows, viz_cols),
             label=batch2grid(data["Y_valid"][:n_viz], viz_rows, viz_cols),
@@ -511,8 +1132,8 @@ class SegmentationModel(object):
 #                                                  PRETRAINED SEGMENTATION MODEL
 # ==============================================================================
 class PretrainedSegmentationModel(SegmentationModel):
-    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou"):
-        super().__init__(name=name, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric)
+    def __init__(self, name, pretrained_snapshot, img_shape=299, n_channels=3, n_classes=10, dynamic=False, l2=None, best_evals_metric="valid_iou", read_only=False):
+        super().__init__(name=name, img_shape=img_shape, n_channels=n_channels, n_classes=n_classes, dynamic=dynamic, l2=l2, best_evals_metric=best_evals_metric, read_only=read_only)
         self.pretrained_snapshot = pretrained_snapshot
         print("CREATED model with snapshot: ", self.pretrained_snapshot)
 
@@ -627,6 +1248,47 @@ class PretrainedSegmentationModel(SegmentationModel):
 
 
 
+# ==============================================================================
+#                                                      FROZEN SEGMENTATION MODEL
+# ==============================================================================
+class FrozenSegmentationModel(SegmentationInference):
+    """ Inference only model loaded from a frozen GraphDef file created by
+        `SegmentationModel.export_frozen_graph()`. It has the same
+        prediction API as `SegmentationModel`, but does not build any
+        training ops, restore any snapshots, or create a model directory.
+
+    Examples:
+        model = FrozenSegmentationModel("models/mymodel/frozen_graph.pb")
+        with model.create_session() as session:
+            preds = model.predict(X, session=session)
+    """
+    def __init__(self, graph_file):
+        self.graph_file = graph_file
+        self.dynamic = False
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.X, self.is_training, self.preds, self.probs = graph_from_graphdef_file(
+                graph_file,
+                access_these=["inputs/X:0", "inputs/is_training:0", "preds:0", "probs:0"])
+        _, self.img_height, self.img_width, self.n_channels = self.X.shape.as_list()
+        self.img_shape = [self.img_width, self.img_height]
+        self.n_classes = self.probs.shape.as_list()[-1]
+        self.single_class_mode = self.n_classes == 2 # road vs non-road
+        self.profile_dir = os.path.join(os.path.dirname(graph_file), "profiles")
+        self.profile_n_top = 20
+
+    def initialize_vars(self, session, best=False):
+        """ Nothing to initialize, the weights are constants in the graph """
+        pass
+
+    def predict(self, X, batch_size=32, verbose=True, session=None, **kwargs):
+        if session is None:
+            with self.create_session() as sess:
+                return self.predict_in_session(X, session=sess, batch_size=batch_size, verbose=verbose)
+        else:
+            return self.predict_in_session(X, session=session, batch_size=batch_size, verbose=verbose)
+
+
 # ==============================================================================
 #                                                       GRAPH_FROM_GRAPHDEF_FILE
 # ==============================================================================
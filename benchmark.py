@@ -0,0 +1,172 @@
+"""
+Benchmarks the speed of the architectures in `architectures.arc`, with random
+weights, over a grid of image sizes and batch sizes. For each combination it
+times the forward pass only (inference), and a full training step (forward,
+backward and weight update), and saves the results to a JSON file.
+
+A previous results file can be given as a baseline, to flag any combination
+whose median latency got slower by more than a tolerance.
+
+Example:
+    python benchmark.py -a SimpleSegA InceptionV3_SegmenterA -d 128 299 -b 1 8 -o bench.json
+    python benchmark.py -a SimpleSegA -d 128 -b 1 8 -o new.json --baseline bench.json
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+from architectures import arc, build_model
+
+
+# ==============================================================================
+#                                                                    TIME_RUNS
+# ==============================================================================
+def time_runs(session, fetches, feed_dict, n_warmup=3, n_runs=20):
+    """ Runs the fetches `n_warmup` times without timing them (to exclude one
+        off costs such as memory allocation and autotuning), then returns a
+        list of the durations (in seconds) of `n_runs` timed runs """
+    for i in range(n_warmup):
+        session.run(fetches, feed_dict=feed_dict)
+    durations = []
+    for i in range(n_runs):
+        t0 = time.time()
+        session.run(fetches, feed_dict=feed_dict)
+        durations.append(time.time()-t0)
+    return durations
+
+
+def summarize_durations(durations, batch_size):
+    """ Returns a dictionary of latency stats (in ms) and throughput """
+    durations = np.array(durations)*1000
+    return {
+        "mean_ms": float(np.mean(durations)),
+        "std_ms": float(np.std(durations)),
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p90_ms": float(np.percentile(durations, 90)),
+        "p99_ms": float(np.percentile(durations, 99)),
+        "images_per_sec": float(batch_size/(np.median(durations)/1000)),
+        }
+
+
+# ==============================================================================
+#                                                                  BENCHMARK_ARC
+# ==============================================================================
+def benchmark_arc(arc_name, img_dim, batch_sizes, n_warmup=3, n_runs=20, modes=("forward", "train")):
+    """ Builds the architecture with random weights (in a temporary model
+        directory), and returns a list of results, one for each batch size
+        and mode """
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        model = build_model(arc_name, name=os.path.join(tmp_dir, arc_name), img_shape=[img_dim, img_dim])
+        with model.graph.as_default():
+            init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+        with model.create_session() as session:
+            session.run(init)
+            for batch_size in batch_sizes:
+                X = np.random.randint(0, 256, size=[batch_size, model.img_height, model.img_width, model.n_channels]).astype(np.uint8)
+                Y = np.random.randint(0, model.n_classes, size=[batch_size, model.img_height, model.img_width]).astype(np.int32)
+                for mode in modes:
+                    if mode == "forward":
+                        fetches = model.preds
+                        feed_dict = {model.X: X, model.is_training: False}
+                    else:
+                        fetches = [model.loss, model.train_op]
+                        feed_dict = {model.X: X, model.Y: Y, model.alpha: 0.0, model.is_training: True, model.dropout: 0.0}
+                    result = {"arc": arc_name, "img_dim": img_dim, "batch_size": batch_size, "mode": mode}
+                    try:
+                        result.update(summarize_durations(time_runs(session, fetches, feed_dict, n_warmup=n_warmup, n_runs=n_runs), batch_size))
+                    except tf.errors.OpError as e:
+                        result["error"] = e.message.split("\n")[0]
+                    results.append(result)
+                    print_result(result)
+    except Exception as e:
+        # eg. image size too small for the number of downsamples
+        for batch_size in batch_sizes:
+            for mode in modes:
+                result = {"arc": arc_name, "img_dim": img_dim, "batch_size": batch_size, "mode": mode, "error": str(e).split("\n")[0]}
+                results.append(result)
+                print_result(result)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def print_result(result):
+    template = "{arc:<24} {img_dim:>5} {batch_size:>5} {mode:<8} "
+    if "error" in result:
+        print(template.format(**result) + "ERROR: " + result["error"])
+    else:
+        print((template + "p50: {p50_ms:9.2f} ms  p90: {p90_ms:9.2f} ms  p99: {p99_ms:9.2f} ms  {images_per_sec:9.2f} img/s").format(**result))
+
+
+# ==============================================================================
+#                                                           COMPARE_TO_BASELINE
+# ==============================================================================
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """ Given the results of a run and of a baseline run, it returns a list
+        of (result, baseline_result, ratio) for all the combinations whose
+        median latency is more than `tolerance` (fraction) slower """
+    key = lambda r: (r["arc"], r["img_dim"], r["batch_size"], r["mode"])
+    baseline = {key(r): r for r in baseline if "error" not in r}
+    regressions = []
+    for r in results:
+        b = baseline.get(key(r))
+        if b is None or "error" in r:
+            continue
+        ratio = r["p50_ms"]/b["p50_ms"]
+        if ratio > 1 + tolerance:
+            regressions.append((r, b, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description="Benchmark the speed of the architectures")
+    p.add_argument("-a", "--arcs", type=str, nargs="+", default=sorted(arc.keys()), help="Architectures to benchmark (default all)")
+    p.add_argument("-d", "--img_dims", type=int, nargs="+", default=[128, 299], help="Image dimensions to benchmark")
+    p.add_argument("-b", "--batch_sizes", type=int, nargs="+", default=[1, 8, 32], help="Batch sizes to benchmark")
+    p.add_argument("-m", "--modes", type=str, nargs="+", default=["forward", "train"], help="What to time [forward, train]")
+    p.add_argument("-w", "--n_warmup", type=int, default=3, help="Num untimed warmup runs")
+    p.add_argument("-n", "--n_runs", type=int, default=20, help="Num timed runs")
+    p.add_argument("-o", "--output", type=str, default="benchmark.json", help="Path to save the results to")
+    p.add_argument("--baseline", type=str, default=None, help="Path to a previous results file to compare against")
+    p.add_argument("--tolerance", type=float, default=0.1, help="Fraction by which the median latency can be slower than the baseline before it is flagged")
+    opt = p.parse_args()
+
+    results = []
+    for arc_name in opt.arcs:
+        for img_dim in opt.img_dims:
+            results.extend(benchmark_arc(arc_name, img_dim, opt.batch_sizes, n_warmup=opt.n_warmup, n_runs=opt.n_runs, modes=opt.modes))
+
+    output = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "tf_version": tf.__version__,
+        "platform": platform.platform(),
+        "n_warmup": opt.n_warmup,
+        "n_runs": opt.n_runs,
+        "results": results,
+        }
+    with open(opt.output, mode="w") as fileObj:
+        json.dump(output, fileObj, indent=2)
+    print("Saved results to: \n- {}".format(opt.output))
+
+    if opt.baseline is not None:
+        with open(opt.baseline, mode="r") as fileObj:
+            baseline = json.load(fileObj)["results"]
+        regressions = compare_to_baseline(results, baseline, tolerance=opt.tolerance)
+        if len(regressions) == 0:
+            print("No regressions against baseline (tolerance {:0.0f}%)".format(100*opt.tolerance))
+        else:
+            print("REGRESSIONS AGAINST BASELINE (tolerance {:0.0f}%)".format(100*opt.tolerance))
+            for r, b, ratio in regressions:
+                print("{arc:<24} {img_dim:>5} {batch_size:>5} {mode:<8} ".format(**r) + "p50: {:9.2f} ms -> {:9.2f} ms ({:+0.1f}%)".format(b["p50_ms"], r["p50_ms"], 100*(ratio-1)))
+            sys.exit(1)
@@ -0,0 +1,215 @@
+"""
+Coarse to fine cascade inference. A cheap model (eg. `SimpleSegA` at a low
+resolution) segments the whole image first. Only the tiles that contain
+pixels whose road probability is close to the decision boundary get passed
+on to the expensive model, at full resolution.
+
+Example:
+    python cascade.py -i "data/testing/image_2/*.png" \\
+        --coarse_name simple --coarse_arc SimpleSegA --coarse_dim 64 \\
+        --fine_name incept --fine_arc InceptionV3_SegmenterC --fine_dim 299 \\
+        --margin 0.2 -o preds
+"""
+from __future__ import print_function, division
+import os
+import time
+import numpy as np
+import cv2
+
+from tiling import tile_grid, pad_to_tile_size
+
+
+# ==============================================================================
+#                                                              CASCADE_SEGMENTER
+# ==============================================================================
+class CascadeSegmenter(object):
+    """ Segments images with a coarse model, and refines the uncertain tiles
+        with a fine model.
+
+    Args:
+        coarse_model, coarse_session: Cheap model, and a session with its
+                        weights loaded. It is run on the whole image, resized
+                        to its input size.
+        fine_model, fine_session: Expensive model, and a session with its
+                        weights loaded. It is run on tiles of the full
+                        resolution image, resized to its input size.
+        margin:         (float) Pixels whose coarse road probability is within
+                        `margin` of 0.5 are uncertain.
+        min_uncertain:  (float) Fraction of uncertain pixels a tile needs to
+                        have to get refined.
+        tile_size:      (int) Side length of tiles in image pixels. Defaults to
+                        the fine model's input size.
+        stride:         (int) Distance between tiles. Defaults to tile_size.
+    """
+    def __init__(self, coarse_model, coarse_session, fine_model, fine_session, margin=0.2, min_uncertain=0.01, tile_size=None, stride=None):
+        self.coarse_model = coarse_model
+        self.coarse_session = coarse_session
+        self.fine_model = fine_model
+        self.fine_session = fine_session
+        self.margin = margin
+        self.min_uncertain = min_uncertain
+        self.tile_size = tile_size if tile_size is not None else fine_model.img_width
+        self.stride = stride if stride is not None else self.tile_size
+
+        # Stats
+        self.n_images = 0
+        self.n_pixels = 0
+        self.n_refined_pixels = 0
+        self.n_tiles = 0
+        self.n_refined_tiles = 0
+        self.coarse_time = 0.0
+        self.fine_time = 0.0
+        self.n_fine_only_images = 0
+        self.fine_only_time = 0.0
+
+    def fine_tiles(self, padded, positions):
+        """ Returns the tiles of the padded image at the given (row, col)
+            positions, resized to the input size of the fine model """
+        t = self.tile_size
+        dims = (self.fine_model.img_width, self.fine_model.img_height)
+        return np.array([cv2.resize(padded[y:y+t, x:x+t], dims, interpolation=cv2.INTER_LINEAR) for y, x in positions])
+
+    def measure_fine_only(self, img):
+        """ Times running the fine model on every tile of the image, which
+            is what the cascade saves compared to. The first call is an
+            untimed warmup run. The mean time per image is used for the
+            speedup reported by `stats()`. """
+        padded = pad_to_tile_size(img, self.tile_size)
+        grid = tile_grid(padded.shape, self.tile_size, self.stride)
+        if self.n_fine_only_images == 0:
+            self.fine_model.predict_probs_in_session(self.fine_tiles(padded, grid), session=self.fine_session, batch_size=len(grid))
+        t0 = time.time()
+        self.fine_model.predict_probs_in_session(self.fine_tiles(padded, grid), session=self.fine_session, batch_size=len(grid))
+        self.fine_only_time += time.time() - t0
+        self.n_fine_only_images += 1
+
+    def segment(self, img):
+        """ Given an image of shape [height, width, 3] it returns the predicted
+            class of each pixel, of shape [height, width] """
+        height, width = img.shape[:2]
+        coarse_dims = (self.coarse_model.img_width, self.coarse_model.img_height)
+
+        # COARSE PASS - on the whole image
+        t0 = time.time()
+        scaled = cv2.resize(img, coarse_dims, interpolation=cv2.INTER_AREA)
+        probs = self.coarse_model.predict_probs_in_session(scaled[np.newaxis], session=self.coarse_session, batch_size=1)[0]
+        probs = cv2.resize(probs, (width, height), interpolation=cv2.INTER_LINEAR).reshape(height, width, -1)
+        self.coarse_time += time.time() - t0
+
+        # UNCERTAIN TILES
+        padded = pad_to_tile_size(img, self.tile_size)
+        uncertain = pad_to_tile_size(np.abs(probs[:, :, 1] - 0.5) < self.margin, self.tile_size)
+        grid = tile_grid(padded.shape, self.tile_size, self.stride)
+        t = self.tile_size
+        refine = [(y, x) for y, x in grid if uncertain[y:y+t, x:x+t].mean() >= self.min_uncertain]
+
+        # FINE PASS - only on the uncertain tiles
+        refined_mask = np.zeros([height, width], dtype=bool)
+        if len(refine) > 0:
+            t0 = time.time()
+            tiles = self.fine_tiles(padded, refine)
+            tile_probs = self.fine_model.predict_probs_in_session(tiles, session=self.fine_session, batch_size=len(tiles))
+            self.fine_time += time.time() - t0
+
+            fine_probs, weights = blend_tiles_at(tile_probs, refine, padded.shape, t)
+            refined_mask = weights[:height, :width, 0] > 0
+            probs[refined_mask] = fine_probs[:height, :width][refined_mask]
+
+        self.n_images += 1
+        self.n_pixels += height*width
+        self.n_refined_pixels += refined_mask.sum()
+        self.n_tiles += len(grid)
+        self.n_refined_tiles += len(refine)
+        return probs.argmax(axis=-1)
+
+    def stats(self):
+        """ Returns a dictionary with the fraction of pixels and tiles refined,
+            the times spent in each model, and the speedup over running the
+            fine model on all tiles. The speedup compares the mean time per
+            image of the cascade with that of the fine only passes timed by
+            `measure_fine_only()`, and is None if there were none. """
+        cascade_time = self.coarse_time + self.fine_time
+        if self.n_fine_only_images > 0 and self.n_images > 0 and cascade_time > 0:
+            speedup = (self.fine_only_time/self.n_fine_only_images) / (cascade_time/self.n_images)
+        else:
+            speedup = None
+        return {
+            "refined_pixels": self.n_refined_pixels/max(self.n_pixels, 1),
+            "refined_tiles": self.n_refined_tiles/max(self.n_tiles, 1),
+            "coarse_time": self.coarse_time,
+            "fine_time": self.fine_time,
+            "fine_only_time": self.fine_only_time,
+            "speedup": speedup,
+            }
+
+
+def blend_tiles_at(tile_probs, positions, padded_shape, tile_size):
+    """ Averages the probabilities of a subset of tiles at the given (row, col)
+        positions into a map of `padded_shape`. Returns the map, and the
+        number of tiles covering each pixel (0 for pixels not covered). """
+    n_classes = tile_probs.shape[-1]
+    total = np.zeros(list(padded_shape[:2])+[n_classes], dtype=np.float32)
+    weights = np.zeros(list(padded_shape[:2])+[1], dtype=np.float32)
+    for probs, (y, x) in zip(tile_probs, positions):
+        probs = cv2.resize(probs, (tile_size, tile_size), interpolation=cv2.INTER_LINEAR)
+        total[y:y+tile_size, x:x+tile_size] += probs.reshape(tile_size, tile_size, n_classes)
+        weights[y:y+tile_size, x:x+tile_size] += 1
+    return total/np.maximum(weights, 1), weights
+
+
+if __name__ == '__main__':
+    import argparse
+    import distutils.util
+    import PIL
+    from PIL import Image
+    from architectures import load_model
+    from segment_dir import list_images, output_file
+
+    p = argparse.ArgumentParser(description="Coarse to fine cascade segmentation of images")
+    p.add_argument("-i", "--input", type=str, help="Directory of images, or glob pattern of image files")
+    p.add_argument("-o", "--output_dir", type=str, default=None, help="Directory to save masks to (optional)")
+    p.add_argument("--coarse_name", type=str, help="Name of the cheap model")
+    p.add_argument("--coarse_arc", type=str, default="SimpleSegA", help="Architecture of the cheap model")
+    p.add_argument("--coarse_dim", type=int, default=64, help="Image dimension of the cheap model")
+    p.add_argument("--coarse_graph", type=str, default=None, help="Frozen graph of the cheap model (instead of name/arc)")
+    p.add_argument("--fine_name", type=str, help="Name of the expensive model")
+    p.add_argument("--fine_arc", type=str, help="Architecture of the expensive model")
+    p.add_argument("--fine_dim", type=int, default=299, help="Image dimension of the expensive model")
+    p.add_argument("--fine_graph", type=str, default=None, help="Frozen graph of the expensive model (instead of name/arc)")
+    p.add_argument("--best", default=True, type=lambda x:bool(distutils.util.strtobool(x)), help="Use best snapshots? False uses latest snapshots")
+    p.add_argument("--margin", type=float, default=0.2, help="Pixels with road probability within this margin of 0.5 are uncertain")
+    p.add_argument("--min_uncertain", type=float, default=0.01, help="Min fraction of uncertain pixels for a tile to get refined")
+    p.add_argument("--tile_size", type=int, default=None, help="Tile side length in image pixels (defaults to fine model input size)")
+    p.add_argument("--stride", type=int, default=None, help="Distance between tiles (defaults to tile size)")
+    p.add_argument("--n_measure", type=int, default=3, help="Num images to also time the fine model on all tiles of, to measure the speedup")
+    opt = p.parse_args()
+
+    coarse_model = load_model(opt.coarse_arc, name=opt.coarse_name, img_dim=opt.coarse_dim, graph=opt.coarse_graph)
+    fine_model = load_model(opt.fine_arc, name=opt.fine_name, img_dim=opt.fine_dim, graph=opt.fine_graph)
+    files = list_images(opt.input)
+
+    with coarse_model.create_session() as coarse_session, fine_model.create_session() as fine_session:
+        coarse_model.initialize_vars(coarse_session, best=opt.best)
+        fine_model.initialize_vars(fine_session, best=opt.best)
+        cascade = CascadeSegmenter(coarse_model, coarse_session, fine_model, fine_session, margin=opt.margin, min_uncertain=opt.min_uncertain, tile_size=opt.tile_size, stride=opt.stride)
+
+        for i, file in enumerate(files):
+            img = np.asarray(PIL.Image.open(file).convert("RGB"))
+            if i < opt.n_measure:
+                cascade.measure_fine_only(img)
+            pred = cascade.segment(img)
+            if opt.output_dir is not None:
+                if not os.path.exists(opt.output_dir):
+                    os.makedirs(opt.output_dir)
+                PIL.Image.fromarray((pred==1).astype(np.uint8)*255).save(output_file(file, opt.output_dir), "PNG")
+
+    stats = cascade.stats()
+    print("Segmented {} images".format(len(files)))
+    print("- Pixels refined:  {:0.1f}%".format(100*stats["refined_pixels"]))
+    print("- Tiles refined:   {:0.1f}%".format(100*stats["refined_tiles"]))
+    print("- Coarse time:     {:0.2f} s".format(stats["coarse_time"]))
+    print("- Fine time:       {:0.2f} s".format(stats["fine_time"]))
+    if stats["speedup"] is not None:
+        print("- Speedup over fine model on all tiles: {:0.2f}x (measured on {} images)".format(stats["speedup"], cascade.n_fine_only_images))
+    else:
+        print("- Speedup over fine model on all tiles: not measured (see --n_measure)")
@@ -13,6 +13,7 @@ import numpy as np
 import scipy
 from scipy import misc
 import pickle
+import json
 
 id2label = ["non-road", "road"]
 label2id = {val:id for id,val in enumerate(id2label)}
@@ -102,6 +103,53 @@ def str2file(s, file, append=True, sep="\n"):
         textFile.write(s)
 
 
+# ==============================================================================
+#                                                                     DICT2JSONL
+# ==============================================================================
+def dict2jsonl(d, file):
+    """ Appends a dictionary as a single line of JSON to the end of a file.
+        Numpy scalars are converted to plain python values.
+    """
+    maybe_make_pardir(file)
+    line = json.dumps(d, default=lambda x: x.item() if hasattr(x, "item") else str(x))
+    with open(file, mode="a") as textFile:
+        textFile.write(line + "\n")
+
+
+# ==============================================================================
+#                                                                    JSONL2DICTS
+# ==============================================================================
+def jsonl2dicts(file, offset=0):
+    """ Reads the dictionaries stored one per line in a JSONL file, starting
+        from byte `offset`. Returns a tuple (dicts, new_offset), so that the
+        file can be tailed cheaply by passing `new_offset` on the next call.
+
+        A trailing line that has not been completely written yet is left for
+        the next call.
+    """
+    dicts = []
+    with open(file, mode="rb") as fileObj:
+        fileObj.seek(offset)
+        for line in fileObj:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if line.strip() != b"":
+                dicts.append(json.loads(line.decode("utf-8")))
+    return dicts, offset
+
+
+# ==============================================================================
+#                                                                  LABEL_IMG2IDS
+# ==============================================================================
+def label_img2ids(label_img):
+    """ Given a KITTI road label image (RGB array), it returns an array with
+        only one channel, with the class id of each pixel (1=road, 0=not road)
+    """
+    non_road_class = np.array([255,0,0])
+    return (1-np.all(label_img==non_road_class, axis=2, keepdims=False)).astype(np.uint8)
+
+
 # ==============================================================================
 #                                                               CREATE_DATA_DICT
 # ==============================================================================
@@ -116,6 +164,10 @@ def create_data_dict(data_dir, img_size=[25, 83]):
         data["X_train"] = numpy array of input images (0-255 uint8)
         data["Y_train"] = numpy array of label images (uint8)
                           (pixel value representing class label)
+        data["img_files_train"] = numpy array of paths to the original
+                          (full resolution) input image of each sample
+        data["label_files_train"] = numpy array of paths to the original
+                          (full resolution) label image of each sample
     """
     print("Creating data dictionary")
     print("- Using data at:", data_dir)
@@ -151,9 +203,7 @@ def create_data_dict(data_dir, img_size=[25, 83]):
         input_img = scipy.misc.imresize(input_img, img_size)
 
         # PROCESSING LABEL IMAGE
-        # Only one channel, (1=road, 0=not road)
-        non_road_class = np.array([255,0,0])
-        label_img = (1-np.all(label_img==non_road_class, axis=2, keepdims=False)).astype(np.uint8)
+        label_img = label_img2ids(label_img)
 
         # Place the images into the data arrays
         data["X_train"][i] = input_img
@@ -164,6 +214,8 @@ def create_data_dict(data_dir, img_size=[25, 83]):
     ids = list(np.random.permutation(n_samples))
     data["X_train"] = data["X_train"][ids]
     data["Y_train"] = data["Y_train"][ids]
+    data["img_files_train"] = np.array(img_files)[ids]
+    data["label_files_train"] = np.array(label_files)[ids]
 
     print("- Done!")
     return data
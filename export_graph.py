@@ -0,0 +1,31 @@
+"""
+Exports a trained model as a frozen, inference only, GraphDef (*.pb) file.
+The weights are stored as constants, and all training ops (optimizer slots,
+loss, evaluation metrics, savers) are pruned away.
+
+Load it with `base.FrozenSegmentationModel`, or pass it to the `--graph`
+argument of `video_feed.py` and `serve.py`.
+
+Example:
+    python export_graph.py mymodel --arc SimpleSegA -d 128
+"""
+from __future__ import print_function, division
+import os
+import distutils.util
+from architectures import build_model
+
+import argparse
+p = argparse.ArgumentParser(description="Export a model as a frozen inference graph")
+p.add_argument("name", type=str, help="model name")
+p.add_argument("--arc", type=str, help="model architecture")
+p.add_argument("-d", "--img_dim", type=int, default=299, help="image dimension (64, 128, 224, 299)")
+p.add_argument("--best", default=True, type=lambda x:bool(distutils.util.strtobool(x)), help="Use best snapshot? False uses latest snapshot")
+p.add_argument("-s", "--saveto", type=str, default=None, help="Path to save the graph to. Defaults to `frozen_graph.pb` in the model directory")
+opt = p.parse_args()
+
+model = build_model(opt.arc, name=opt.name, img_shape=[opt.img_dim, opt.img_dim])
+saveto = opt.saveto if opt.saveto is not None else os.path.join(model.model_dir, "frozen_graph.pb")
+
+with model.create_session() as session:
+    model.initialize_vars(session=session, best=opt.best)
+    model.export_frozen_graph(session, saveto)
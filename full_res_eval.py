@@ -0,0 +1,199 @@
+"""
+Evaluates a model against the original, full resolution KITTI label images,
+instead of the downsized labels stored in the data dictionary.
+
+The predicted class probabilities of each batch get upsampled back to the
+native size of each image (bilinear interpolation, as two matrix products
+per group of images of the same size), and the metrics are accumulated at
+full resolution: the confusion matrix, and the KITTI road benchmark MaxF and
+AP of the road class. Decoding the label PNGs, and the upsampling, run in a
+pool of worker threads while the next batch goes through the model.
+
+It needs a data file created with a version of `create_data_dict()` that
+stores the paths to the original label files ("label_files_train").
+
+Example:
+    python full_res_eval.py mymodel --arc SimpleSegA -d 128 --data data_128x128.pickle
+"""
+from __future__ import print_function, division
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import PIL
+from PIL import Image
+
+from data_processing import label_img2ids
+from metrics import confusion_matrix, batch_confusion_matrices, scores_from_confusion, ProbabilityHistogramEvaluator
+from base import pretty_time
+
+
+# ==============================================================================
+#                                                                       UPSAMPLE
+# ==============================================================================
+_interpolation_matrices = {}
+def interpolation_matrix(n_out, n_in):
+    """ Returns a matrix of shape [n_out, n_in] that resizes a signal of
+        length n_in to length n_out with linear interpolation (using pixel
+        centers, the same way as cv2 and PIL do) """
+    key = (n_out, n_in)
+    if key not in _interpolation_matrices:
+        x = np.clip((np.arange(n_out)+0.5)*n_in/n_out - 0.5, 0, n_in-1)
+        lo = np.floor(x).astype(np.int64)
+        hi = np.minimum(lo+1, n_in-1)
+        frac = (x - lo).astype(np.float32)
+        mtx = np.zeros([n_out, n_in], dtype=np.float32)
+        np.add.at(mtx, (np.arange(n_out), lo), 1-frac)
+        np.add.at(mtx, (np.arange(n_out), hi), frac)
+        _interpolation_matrices[key] = mtx
+    return _interpolation_matrices[key]
+
+
+def upsample_probs(probs, height, width):
+    """ Given a batch of class probabilities of shape
+        [n_images, rows, cols, n_classes], it resizes them to
+        [height, width] with bilinear interpolation, and returns them with
+        the shape [n_images, n_classes, height, width] """
+    rows, cols = probs.shape[1:3]
+    probs = np.transpose(probs, [0, 3, 1, 2])   # [n, classes, rows, cols]
+    probs = np.matmul(interpolation_matrix(height, rows), probs)
+    return np.matmul(probs, interpolation_matrix(width, cols).T)
+
+
+def upsample_preds(probs, height, width):
+    """ Like `upsample_probs()`, but returns the predicted class of each
+        pixel, of shape [n_images, height, width] """
+    return upsample_probs(probs, height, width).argmax(axis=1)
+
+
+# ==============================================================================
+#                                                                        WORKERS
+# ==============================================================================
+def decode_label(file):
+    """ Returns the class ids of the original label image file """
+    return label_img2ids(np.asarray(PIL.Image.open(file).convert("RGB")))
+
+
+def evaluate_group(probs, labels, n_classes, n_bins):
+    """ Upsamples the probs of a group of images that share the same native
+        size, and returns the confusion matrix of each image, and a
+        `ProbabilityHistogramEvaluator` of the road class over the group """
+    height, width = labels.shape[1:3]
+    probs = upsample_probs(probs, height, width)
+    evaluator = ProbabilityHistogramEvaluator(n_bins=n_bins)
+    evaluator.update(labels, probs[:, 1])
+    return batch_confusion_matrices(labels, probs.argmax(axis=1), n_classes), evaluator
+
+
+# ==============================================================================
+#                                                              EVALUATE_FULL_RES
+# ==============================================================================
+def evaluate_full_res(model, session, X, label_files, batch_size=16, n_workers=4, Y=None, n_bins=256):
+    """ Evaluates the model on the images X, against the original label
+        images in `label_files`.
+
+        Returns a dictionary with the full resolution scores (see
+        `metrics.scores_from_confusion()`), plus:
+            "image_scores": The scores of each individual image
+            "score":        The IoU score the model reports in training
+                            (class 1 in single class mode, otherwise mean)
+            "pr":           The KITTI road benchmark scores of the road
+                            class, over `n_bins` thresholds ("max_f", "ap",
+                            and the "threshold", "precision" and "recall"
+                            at MaxF). See `metrics.ProbabilityHistogramEvaluator`
+            "low_res_score": The same, against the downsized labels Y (only
+                            if Y is given)
+            "duration":     Time taken in seconds
+    """
+    n_samples = len(X)
+    n_classes = model.n_classes
+    pool = ThreadPool(n_workers)
+    batches = [(i, min(i+batch_size, n_samples)) for i in range(0, n_samples, batch_size)]
+    max_pending = 2*n_workers
+    pending = []
+    image_mtxs = [None]*n_samples
+    low_res_mtx = np.zeros([n_classes, n_classes], dtype=np.int64)
+    pr_evaluator = ProbabilityHistogramEvaluator(n_bins=n_bins)
+    t0 = time.time()
+
+    def collect(result):
+        ids, (mtxs, evaluator) = result[0], result[1].get()
+        for i, mtx in zip(ids, mtxs):
+            image_mtxs[i] = mtx
+        pr_evaluator.merge(evaluator)
+
+    # Decode the labels of the next batch while the current one goes
+    # through the model
+    next_labels = pool.map_async(decode_label, label_files[batches[0][0]: batches[0][1]]) if batches else None
+    for b, (start, end) in enumerate(batches):
+        probs = model.predict_probs_in_session(X[start: end], session=session, batch_size=end-start)
+        if Y is not None:
+            low_res_mtx += confusion_matrix(Y[start: end], probs.argmax(axis=-1), n_classes)
+
+        labels = next_labels.get()
+        if b+1 < len(batches):
+            next_labels = pool.map_async(decode_label, label_files[batches[b+1][0]: batches[b+1][1]])
+
+        # Upsample each group of images with the same native size together
+        shapes = [label.shape for label in labels]
+        for shape in sorted(set(shapes)):
+            group = [i for i, s in enumerate(shapes) if s == shape]
+            group_labels = np.array([labels[i] for i in group])
+            result = pool.apply_async(evaluate_group, (probs[group], group_labels, n_classes, n_bins))
+            pending.append(([start+i for i in group], result))
+
+        # Limit the num of groups waiting to be evaluated, to bound memory
+        while len(pending) > max_pending:
+            collect(pending.pop(0))
+
+        print("\r{} {}/{} images".format(pretty_time(time.time()-t0), end, n_samples), end="")
+
+    for result in pending:
+        collect(result)
+    pool.close()
+    print("")
+
+    image_mtxs = np.array(image_mtxs)
+    scores = scores_from_confusion(image_mtxs.sum(axis=0))
+    scores["image_scores"] = scores_from_confusion(image_mtxs)
+    scores["score"] = model.iou_from_confusion_mtx(image_mtxs.sum(axis=0))
+    scores["pr"] = pr_evaluator.scores()
+    if Y is not None:
+        scores["low_res_score"] = model.iou_from_confusion_mtx(low_res_mtx)
+    scores["duration"] = time.time()-t0
+    return scores
+
+
+if __name__ == '__main__':
+    import argparse
+    from architectures import load_model, add_model_args
+    from data_processing import pickle2obj
+
+    p = argparse.ArgumentParser(description="Evaluate a model against the full resolution labels")
+    add_model_args(p)
+    p.add_argument("--data", type=str, default="data", help="Path to the pickled data file")
+    p.add_argument("-v", "--n_valid",type=int, default=31, help="Num samples set aside for validation set (same as used in training)")
+    p.add_argument("-b", "--batch_size", type=int, default=16, help="Batch size")
+    p.add_argument("-w", "--n_workers", type=int, default=4, help="Num threads decoding labels and upsampling predictions")
+    p.add_argument("--n_bins", type=int, default=256, help="Num of road probability thresholds to compute MaxF and AP over")
+    opt = p.parse_args()
+
+    data = pickle2obj(opt.data)
+    assert "label_files_train" in data, "The data file has no paths to the original label files. Re-create it with create_data_dict()"
+    X_valid, Y_valid = data["X_train"][:opt.n_valid], data["Y_train"][:opt.n_valid]
+    label_files = list(data["label_files_train"][:opt.n_valid])
+
+    model = load_model(opt.arc, name=opt.name, img_dim=opt.img_dim, graph=opt.graph)
+
+    with model.create_session() as session:
+        model.initialize_vars(session, best=opt.best)
+        scores = evaluate_full_res(model, session, X_valid, label_files, batch_size=opt.batch_size, n_workers=opt.n_workers, Y=Y_valid, n_bins=opt.n_bins)
+
+    print("EVALUATED {} IMAGES IN {}".format(len(X_valid), pretty_time(scores["duration"])))
+    print("- IoU at model resolution: {:0.4f}".format(scores["low_res_score"]))
+    print("- IoU at full resolution:  {:0.4f}".format(scores["score"]))
+    print("- MaxF at full resolution: {:0.4f} (threshold: {:0.3f}, precision: {:0.4f}, recall: {:0.4f})".format(scores["pr"]["max_f"], scores["pr"]["threshold"], scores["pr"]["precision"], scores["pr"]["recall"]))
+    print("- AP at full resolution:   {:0.4f}".format(scores["pr"]["ap"]))
+    template = "{:<8} {:>8} {:>10} {:>8} {:>8}"
+    print(template.format("CLASS", "IOU", "PRECISION", "RECALL", "F1"))
+    for i in range(model.n_classes):
+        print(template.format(i, *["{:0.4f}".format(scores[key][i]) for key in ["iou", "precision", "recall", "f1"]]))
@@ -0,0 +1,151 @@
+"""
+Evaluates the latest and best snapshots of every model under `models/` on
+the validation set, in a pool of worker processes, and prints a leaderboard
+ranked by validation IoU.
+
+The architecture and image size of each model is read from the
+`model_info.json` file that training saves in the model directory. Models
+trained before it existed can be given a fallback with `--arc` and
+`--img_dim`.
+
+Example:
+    python leaderboard.py -d data_299x299.pickle -w 4 -t 2
+"""
+from __future__ import print_function, division
+import os
+import json
+import time
+import tempfile
+import multiprocessing
+import numpy as np
+
+from data_processing import pickle2obj
+
+
+# ==============================================================================
+#                                                                    FIND_MODELS
+# ==============================================================================
+def find_models(models_dir="models", default_arc=None, default_img_dim=None):
+    """ Returns a list of dicts with the "name", "model_dir", "arc",
+        "img_shape", "n_classes" and "snapshot" ("latest" or "best") of each
+        snapshot to evaluate. """
+    jobs = []
+    for name in sorted(os.listdir(models_dir)):
+        model_dir = os.path.join(models_dir, name)
+        info_file = os.path.join(model_dir, "model_info.json")
+        if os.path.exists(info_file):
+            with open(info_file, mode="r") as fileObj:
+                info = json.load(fileObj)
+        elif default_arc is not None and default_img_dim is not None:
+            info = {"arc": default_arc, "img_shape": [default_img_dim, default_img_dim], "n_classes": 1}
+        else:
+            print("Skipping {} (no model_info.json, and no --arc/--img_dim fallback)".format(name))
+            continue
+
+        for snapshot, subdir in [("latest", "snapshots"), ("best", "snapshots_best")]:
+            if os.path.exists(os.path.join(model_dir, subdir, "snapshot.chk.index")):
+                jobs.append({"name": name, "model_dir": os.path.abspath(model_dir), "arc": info["arc"], "img_shape": info["img_shape"], "n_classes": info["n_classes"], "snapshot": snapshot})
+    return jobs
+
+
+# ==============================================================================
+#                                                                  EVALUATE_JOB
+# ==============================================================================
+def evaluate_job(args):
+    """ Evaluates a single snapshot. Runs in a worker process, so tensorflow
+        only gets imported (and its thread pools created) in the workers. """
+    job, X_file, Y_file, batch_size, n_threads = args
+    import tensorflow as tf
+    from architectures import build_model
+
+    X = np.load(X_file, mmap_mode="r")  # Shared, read only
+    Y = np.load(Y_file, mmap_mode="r")
+    config = tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=n_threads)
+
+    result = dict(job)
+    try:
+        # The model dir is absolute, so it is used as is, instead of being
+        # placed under `models/`. Read only, as other workers (or a training
+        # run) may be using the same directory.
+        model = build_model(job["arc"], name=job["model_dir"], img_shape=job["img_shape"], n_classes=job["n_classes"], read_only=True)
+        with model.create_session(config=config) as session:
+            # Never evaluate freshly initialized weights
+            snapshot_file = model.best_snapshot_file if job["snapshot"]=="best" else model.snapshot_file
+            if not os.path.exists(snapshot_file + ".index"):
+                raise IOError("Snapshot does not exist: {}".format(snapshot_file))
+            model.initialize_vars(session, best=job["snapshot"]=="best")
+            result["valid_iou"], result["valid_loss"] = model.evaluate_in_session(X, Y, session, batch_size=batch_size)
+
+            # Latency of a single batch (after a warmup run)
+            X_batch = np.array(X[:batch_size])
+            model.predict_in_session(X_batch, session=session, batch_size=batch_size, verbose=False)
+            t0 = time.time()
+            model.predict_in_session(X_batch, session=session, batch_size=batch_size, verbose=False)
+            result["latency_ms"] = 1000*(time.time()-t0)
+    except Exception as e:
+        result["error"] = str(e).split("\n")[0]
+    return result
+
+
+def evaluate_all(jobs, X, Y, n_workers=2, n_threads=2, batch_size=32):
+    """ Evaluates all the jobs in a pool of `n_workers` processes, each using
+        `n_threads` tensorflow threads. Returns the results sorted by IoU """
+    tmp_dir = tempfile.mkdtemp()
+    X_file = os.path.join(tmp_dir, "X_valid.npy")
+    Y_file = os.path.join(tmp_dir, "Y_valid.npy")
+    np.save(X_file, X)
+    np.save(Y_file, Y)
+
+    try:
+        # Spawn fresh processes rather than forking, as tensorflow does not
+        # support being used in a forked child process.
+        pool = multiprocessing.get_context("spawn").Pool(n_workers, maxtasksperchild=1)
+        try:
+            results = pool.map(evaluate_job, [(job, X_file, Y_file, batch_size, n_threads) for job in jobs], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(X_file)
+        os.remove(Y_file)
+        os.rmdir(tmp_dir)
+
+    def sort_key(r):
+        iou = r.get("valid_iou", -1)
+        return -1 if np.isnan(iou) else iou
+    return sorted(results, key=sort_key, reverse=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description="Evaluate all models and rank them")
+    p.add_argument("-d", "--data", type=str, default="data", help="Path to the pickled data file")
+    p.add_argument("-v", "--n_valid",type=int, default=31, help="Num samples set aside for validation set (same as used in training)")
+    p.add_argument("-m", "--models_dir", type=str, default="models", help="Directory containing the model directories")
+    p.add_argument("--arc", type=str, default=None, help="Architecture to assume for models without a model_info.json file")
+    p.add_argument("--img_dim", type=int, default=None, help="Image dimension to assume for models without a model_info.json file")
+    p.add_argument("-w", "--n_workers", type=int, default=2, help="Num worker processes")
+    p.add_argument("-t", "--n_threads", type=int, default=2, help="Num tensorflow threads per worker")
+    p.add_argument("-b", "--batch_size", type=int, default=32, help="Batch size")
+    p.add_argument("-s", "--saveto", type=str, default="leaderboard.json", help="Path to save the results to")
+    opt = p.parse_args()
+
+    data = pickle2obj(opt.data)
+    X_valid, Y_valid = data["X_train"][:opt.n_valid], data["Y_train"][:opt.n_valid]
+    del data
+
+    jobs = find_models(opt.models_dir, default_arc=opt.arc, default_img_dim=opt.img_dim)
+    print("Evaluating {} snapshots".format(len(jobs)))
+    results = evaluate_all(jobs, X_valid, Y_valid, n_workers=opt.n_workers, n_threads=opt.n_threads, batch_size=opt.batch_size)
+
+    template = "{:>4}  {:<30} {:<24} {:<7} {:>8} {:>10} {:>12}"
+    print(template.format("RANK", "NAME", "ARC", "SNAP", "IOU", "LOSS", "LATENCY(ms)"))
+    for rank, r in enumerate(results, 1):
+        if "error" in r:
+            print(template.format(rank, r["name"], r["arc"], r["snapshot"], "-", "-", "-"), " ERROR:", r["error"])
+        else:
+            print(template.format(rank, r["name"], r["arc"], r["snapshot"], "{:0.4f}".format(r["valid_iou"]), "{:0.5f}".format(r["valid_loss"]), "{:0.1f}".format(r["latency_ms"])))
+
+    with open(opt.saveto, mode="w") as fileObj:
+        json.dump(results, fileObj, indent=2, default=float)
+    print("Saved results to: \n- {}".format(opt.saveto))
@@ -0,0 +1,197 @@
+"""
+Memory accounting, to find out where the memory of a training run goes.
+
+It reports:
+    - The bytes of each array in the data dictionary, and whether it is a
+      copy that owns its memory, or a view into another array. Views keep
+      the whole array they are a view of alive, even if that array is no
+      longer in the data dictionary (eg. a slice taken before the training
+      data got shuffled into a new array).
+    - The peak resident set size (RSS) of the process during each phase
+      (eg. load, graph build, each epoch and evaluation).
+    - Tensorflow allocator stats.
+
+Example:
+    tracker = MemoryTracker(enabled=True)
+    tracker.start_phase("load")
+    data = pickle2obj("data.pickle")
+    tracker.start_phase("graph_build")
+    ...
+    tracker.record_arrays(data)
+    tracker.end_phase()
+    tracker.save("memory_report.txt")
+"""
+from __future__ import print_function, division
+import os
+import time
+import numpy as np
+try:
+    import resource
+except ImportError:  # Not available on windows
+    resource = None
+
+
+# ==============================================================================
+#                                                                            RSS
+# ==============================================================================
+def _proc_status_bytes(field):
+    """ Returns the value of a field (eg "VmRSS") of /proc/self/status in
+        bytes, or None if not available (non linux systems) """
+    try:
+        with open("/proc/self/status", mode="r") as fileObj:
+            for line in fileObj:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def current_rss():
+    """ Returns the current resident set size of the process in bytes """
+    return _proc_status_bytes("VmRSS")
+
+
+def peak_rss():
+    """ Returns the peak resident set size in bytes, since the process
+        started, or since the last call to `reset_peak_rss()` """
+    peak = _proc_status_bytes("VmHWM")
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if os.uname()[0] == "Darwin" else peak*1024 # KB on linux
+    return peak
+
+
+def reset_peak_rss():
+    """ Resets the peak RSS (linux only). Returns True if it was reset, if
+        not, the peak is the peak since the process started """
+    try:
+        with open("/proc/self/clear_refs", mode="w") as fileObj:
+            fileObj.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+# ==============================================================================
+#                                                                  ARRAY_MEMORY
+# ==============================================================================
+def root_array(a):
+    """ Returns the array that owns the memory a numpy array is a view of
+        (the array itself if it is not a view) """
+    while isinstance(a.base, np.ndarray):
+        a = a.base
+    return a
+
+
+def array_memory(data):
+    """ Given a dictionary, it returns a list of dicts describing each numpy
+        array in it, with the keys:
+            key, shape, dtype, nbytes:   of the array itself
+            owner:       "self" if the array owns its memory, otherwise the
+                         key of the array it is a view of, or "untracked"
+                         if that array is not in the dictionary.
+            owner_bytes: bytes of the memory that the array keeps alive
+        and the total bytes held by the arrays (counting shared memory once)
+    """
+    arrays = {key: value for key, value in data.items() if isinstance(value, np.ndarray)}
+    roots = {key: root_array(a) for key, a in arrays.items()}
+    root_keys = {id(a): key for key, a in arrays.items() if roots[key] is a}
+
+    rows = []
+    for key in sorted(arrays):
+        a, root = arrays[key], roots[key]
+        owner = "self" if root is a else root_keys.get(id(root), "untracked")
+        rows.append({"key": key, "shape": list(a.shape), "dtype": str(a.dtype), "nbytes": a.nbytes, "owner": owner, "owner_bytes": root.nbytes})
+    unique_roots = {id(root): root for root in roots.values()}
+    total = sum(root.nbytes for root in unique_roots.values())
+    return rows, total
+
+
+# ==============================================================================
+#                                                                 MEMORY_TRACKER
+# ==============================================================================
+class MemoryTracker(object):
+    """ Records the memory used by each phase of a run. Phases are started
+        one after the other with `start_phase()`, which ends the previous
+        one. If `enabled` is False, every method does nothing, so it can be
+        passed around without checks.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+        self.arrays = []
+        self.arrays_total = 0
+        self.arrays_phase = None
+        self.allocator_stats = {}
+        self.current = None
+
+    def start_phase(self, name):
+        """ Ends the current phase (if any) and starts a new one """
+        if not self.enabled:
+            return
+        self.end_phase()
+        self.current = {"name": name, "start_rss": current_rss(), "t0": time.time(), "reset": reset_peak_rss()}
+
+    def end_phase(self):
+        """ Ends the current phase, recording its peak and final RSS """
+        if not self.enabled or self.current is None:
+            return
+        phase = self.current
+        phase["end_rss"] = current_rss()
+        phase["peak_rss"] = peak_rss()
+        phase["duration"] = time.time() - phase.pop("t0")
+        self.phases.append(phase)
+        self.current = None
+
+    def record_arrays(self, data):
+        """ Records the memory of the arrays in the data dictionary """
+        if not self.enabled:
+            return
+        self.arrays, self.arrays_total = array_memory(data)
+        self.arrays_phase = None if self.current is None else self.current["name"]
+
+    def record_allocator_stats(self, stats):
+        """ Records a dictionary of tensorflow allocator stats """
+        if self.enabled:
+            self.allocator_stats = stats
+
+    def report(self):
+        """ Returns the report as a string """
+        mb = lambda n: "-" if n is None else "{:0.1f}".format(n/1e6)
+        lines = []
+        lines.append("="*70 + "\nDATA ARRAYS" + ("" if self.arrays_phase is None else " (during {})".format(self.arrays_phase)) + "\n" + "="*70)
+        template = "{:<16} {:<22} {:<8} {:>10} {:<14} {:>12}"
+        lines.append(template.format("KEY", "SHAPE", "DTYPE", "MB", "OWNER", "OWNER MB"))
+        for row in self.arrays:
+            owner = "copy" if row["owner"] == "self" else "view of " + row["owner"]
+            lines.append(template.format(row["key"], str(tuple(row["shape"])), row["dtype"], mb(row["nbytes"]), owner, mb(row["owner_bytes"])))
+        lines.append("Total held by the arrays (shared memory counted once): {} MB".format(mb(self.arrays_total)))
+        untracked = {}
+        for row in self.arrays:
+            if row["owner"] == "untracked":
+                untracked[row["key"]] = row["owner_bytes"]
+        if len(untracked) > 0:
+            lines.append("NOTE: Views keeping alive arrays that are no longer in the data dict: " + ", ".join(sorted(untracked)))
+
+        lines.append("\n" + "="*70 + "\nPROCESS MEMORY (RSS) PER PHASE\n" + "="*70)
+        template = "{:<20} {:>12} {:>12} {:>12} {:>10}"
+        lines.append(template.format("PHASE", "START MB", "END MB", "PEAK MB", "TIME(s)"))
+        for phase in self.phases:
+            peak = mb(phase["peak_rss"]) + ("" if phase["reset"] else "*")
+            lines.append(template.format(phase["name"], mb(phase["start_rss"]), mb(phase["end_rss"]), peak, "{:0.1f}".format(phase["duration"])))
+        if any(not phase["reset"] for phase in self.phases):
+            lines.append("* Peak since the process started (the peak could not be reset on this system)")
+
+        lines.append("\n" + "="*70 + "\nTENSORFLOW ALLOCATOR\n" + "="*70)
+        for key in sorted(self.allocator_stats):
+            value = self.allocator_stats[key]
+            lines.append("{:<20} {}".format(key, mb(value) + " MB" if isinstance(value, (int, np.integer)) else value))
+        return "\n".join(lines) + "\n"
+
+    def save(self, file):
+        """ Saves the report to a text file """
+        if not self.enabled:
+            return
+        with open(file, mode="w") as fileObj:
+            fileObj.write(self.report())
@@ -0,0 +1,239 @@
+"""
+Segmentation metrics computed from confusion matrices in pure numpy, so they
+can be run on saved predictions without tensorflow.
+
+Confusion matrices have shape [n_classes, n_classes], where rows are the
+labels, and columns are the predictions.
+
+Example:
+    evaluator = SegmentationEvaluator(n_classes=2)
+    for Y_batch, preds_batch in ...:
+        evaluator.update(Y_batch, preds_batch)
+    scores = evaluator.scores()
+    print(scores["iou"][1], scores["mean_iou"])
+"""
+from __future__ import print_function, division
+import warnings
+import numpy as np
+from multiprocessing import Pool
+
+
+# ==============================================================================
+#                                                               CONFUSION_MATRIX
+# ==============================================================================
+def confusion_matrix(labels, preds, n_classes):
+    """ Returns the confusion matrix of all the pixels in `labels` and `preds`
+        (arrays of class ids of any matching shape) """
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    preds = np.asarray(preds, dtype=np.int64).ravel()
+    counts = np.bincount(labels*n_classes + preds, minlength=n_classes*n_classes)
+    return counts.reshape(n_classes, n_classes)
+
+
+def batch_confusion_matrices(labels, preds, n_classes):
+    """ Given a batch of labels and predictions of shape [n_images, ...] it
+        returns the confusion matrix of each image, of shape
+        [n_images, n_classes, n_classes], using a single `np.bincount` """
+    labels = np.asarray(labels, dtype=np.int64)
+    preds = np.asarray(preds, dtype=np.int64)
+    n_images = labels.shape[0]
+    offsets = (np.arange(n_images)*n_classes*n_classes).reshape([-1]+[1]*(labels.ndim-1))
+    ids = offsets + labels*n_classes + preds
+    counts = np.bincount(ids.ravel(), minlength=n_images*n_classes*n_classes)
+    return counts.reshape(n_images, n_classes, n_classes)
+
+
+# ==============================================================================
+#                                                                         SCORES
+# ==============================================================================
+def scores_from_confusion(confusion_mtx):
+    """ Given a confusion matrix of shape [..., n_classes, n_classes] (eg. a
+        single one, or one per image) it returns a dictionary of the per
+        class scores, each of shape [..., n_classes]:
+
+            iou, precision, recall, f1, support (num of label pixels)
+
+        and the mean over the classes present in the labels or predictions:
+
+            mean_iou, mean_precision, mean_recall, mean_f1
+
+        Scores that are undefined (0/0) are nan.
+    """
+    confusion_mtx = np.asarray(confusion_mtx, dtype=np.float64)
+    tp = np.diagonal(confusion_mtx, axis1=-2, axis2=-1)
+    n_preds = confusion_mtx.sum(axis=-2)
+    n_labels = confusion_mtx.sum(axis=-1)
+    fp = n_preds - tp
+    fn = n_labels - tp
+
+    with np.errstate(divide="ignore", invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # nanmean of all nan
+        scores = {
+            "iou": tp / (tp + fp + fn),
+            "precision": tp / n_preds,
+            "recall": tp / n_labels,
+            "f1": 2*tp / (2*tp + fp + fn),
+            "support": n_labels,
+            }
+        for key in ["iou", "precision", "recall", "f1"]:
+            scores["mean_"+key] = np.nanmean(scores[key], axis=-1)
+    return scores
+
+
+def iou_score(confusion_mtx, class_id=None):
+    """ Returns the IoU of `class_id`, or the mean IoU over the classes that
+        are present if `class_id` is None """
+    scores = scores_from_confusion(confusion_mtx)
+    if class_id is None:
+        return scores["mean_iou"]
+    return scores["iou"][..., class_id]
+
+
+# ==============================================================================
+#                                                          SEGMENTATION_EVALUATOR
+# ==============================================================================
+class SegmentationEvaluator(object):
+    """ Accumulates confusion matrices over batches of labels and predictions,
+        both for the whole dataset, and for each individual image. """
+    def __init__(self, n_classes=2):
+        self.n_classes = n_classes
+        self.reset()
+
+    def reset(self):
+        self.confusion_mtx = np.zeros([self.n_classes, self.n_classes], dtype=np.int64)
+        self.image_confusion_mtxs = []
+
+    def update(self, labels, preds):
+        """ Adds a batch of labels and predictions of shape [n_images, ...] """
+        mtxs = batch_confusion_matrices(labels, preds, self.n_classes)
+        self.image_confusion_mtxs.append(mtxs)
+        self.confusion_mtx += mtxs.sum(axis=0)
+
+    def scores(self):
+        """ Returns the dataset level scores (see `scores_from_confusion()`),
+            plus the scores of each image under the key "per_image" """
+        scores = scores_from_confusion(self.confusion_mtx)
+        if len(self.image_confusion_mtxs) > 0:
+            scores["per_image"] = scores_from_confusion(np.concatenate(self.image_confusion_mtxs, axis=0))
+        return scores
+
+
+# ==============================================================================
+#                                                     PROBABILITY_HISTOGRAM_EVALUATOR
+# ==============================================================================
+class ProbabilityHistogramEvaluator(object):
+    """ KITTI road benchmark style evaluation (MaxF and AP) over all
+        confidence thresholds, in a single streaming pass.
+
+        Instead of storing the road probability of every pixel, it keeps a
+        histogram of the probabilities of the positive (road) pixels, and one
+        of the negative pixels. The precision/recall at each bin edge is then
+        computed from their cumulative sums.
+
+    Examples:
+        evaluator = ProbabilityHistogramEvaluator(n_bins=1024)
+        for Y_batch, probs_batch in ...:
+            evaluator.update(Y_batch, probs_batch[..., 1])
+        scores = evaluator.scores()
+        print(scores["max_f"], scores["ap"])
+    """
+    def __init__(self, n_bins=256):
+        self.n_bins = n_bins
+        self.reset()
+
+    def reset(self):
+        self.pos_hist = np.zeros(self.n_bins, dtype=np.int64)
+        self.neg_hist = np.zeros(self.n_bins, dtype=np.int64)
+
+    def update(self, labels, road_probs):
+        """ Adds a batch of binary labels (1=road) and the road probabilities
+            predicted for those pixels (any matching shape) """
+        labels = (np.asarray(labels).ravel() == 1).astype(np.int64)
+        bins = np.minimum((np.asarray(road_probs).ravel()*self.n_bins).astype(np.int64), self.n_bins-1)
+        counts = np.bincount(labels*self.n_bins + bins, minlength=2*self.n_bins)
+        self.neg_hist += counts[:self.n_bins]
+        self.pos_hist += counts[self.n_bins:]
+
+    def merge(self, other):
+        """ Adds the counts of another evaluator with the same num of bins
+            (eg. one that was updated in a different thread) """
+        assert other.n_bins == self.n_bins, "Can only merge evaluators with the same num of bins"
+        self.pos_hist += other.pos_hist
+        self.neg_hist += other.neg_hist
+
+    def curve(self):
+        """ Returns the (thresholds, precision, recall) arrays, where pixels
+            with probability >= threshold are predicted as road. Thresholds
+            are in decreasing order. """
+        thresholds = np.arange(self.n_bins)[::-1]/float(self.n_bins)
+        tp = np.cumsum(self.pos_hist[::-1]).astype(np.float64)
+        fp = np.cumsum(self.neg_hist[::-1]).astype(np.float64)
+        n_pos = max(self.pos_hist.sum(), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = np.where(tp+fp > 0, tp/(tp+fp), 1.0)
+        recall = tp/n_pos
+        return thresholds, precision, recall
+
+    def scores(self):
+        """ Returns a dictionary with:
+                max_f:      Max F1 score over all thresholds
+                threshold:  Threshold at which max_f is reached
+                precision, recall: at that threshold
+                ap:         Average precision, interpolated at the 11 recall
+                            levels 0, 0.1, ..., 1 (as in the KITTI devkit)
+        """
+        thresholds, precision, recall = self.curve()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f = np.nan_to_num(2*precision*recall/(precision+recall))
+        best = np.argmax(f)
+        ap = np.mean([np.max(precision[recall >= r]) if np.any(recall >= r) else 0.0 for r in np.linspace(0, 1, 11)])
+        return {
+            "max_f": f[best],
+            "threshold": thresholds[best],
+            "precision": precision[best],
+            "recall": recall[best],
+            "ap": ap,
+            }
+
+
+# ==============================================================================
+#                                                      PARALLEL CONFUSION MATRIX
+# ==============================================================================
+def _chunk_confusion_matrix(args):
+    labels, preds, n_classes = args
+    return confusion_matrix(labels, preds, n_classes)
+
+
+def parallel_confusion_matrix(labels, preds, n_classes, n_workers=4, chunk_size=64):
+    """ Computes the confusion matrix of a large set of labels and predictions
+        of shape [n_images, ...] (eg. memmaps of saved predictions), by
+        splitting the images into chunks processed by a pool of workers """
+    chunks = [(labels[i: i+chunk_size], preds[i: i+chunk_size], n_classes) for i in range(0, len(labels), chunk_size)]
+    pool = Pool(n_workers)
+    try:
+        mtxs = pool.map(_chunk_confusion_matrix, chunks)
+    finally:
+        pool.close()
+    return np.sum(mtxs, axis=0)
+
+
+if __name__ == '__main__':
+    import argparse
+    from data_processing import pickle2obj
+    p = argparse.ArgumentParser(description="Evaluate saved predictions against the validation labels")
+    p.add_argument("preds", type=str, help="Path to a .npy file of predictions of shape [n_samples, height, width]")
+    p.add_argument("-d", "--data", type=str, default="data", help="Path to the pickled data file")
+    p.add_argument("-v", "--n_valid",type=int, default=31, help="Num samples set aside for validation set (same as used in training)")
+    p.add_argument("-n", "--n_classes", type=int, default=2, help="Num classes")
+    p.add_argument("-w", "--n_workers", type=int, default=4, help="Num worker processes")
+    opt = p.parse_args()
+
+    Y = pickle2obj(opt.data)["Y_train"][:opt.n_valid]
+    preds = np.load(opt.preds, mmap_mode="r")
+    scores = scores_from_confusion(parallel_confusion_matrix(Y, preds, opt.n_classes, n_workers=opt.n_workers))
+
+    template = "{:<8} {:>8} {:>10} {:>8} {:>8}"
+    print(template.format("CLASS", "IOU", "PRECISION", "RECALL", "F1"))
+    for i in range(opt.n_classes):
+        print(template.format(i, *["{:0.4f}".format(scores[key][i]) for key in ["iou", "precision", "recall", "f1"]]))
+    print(template.format("MEAN", *["{:0.4f}".format(scores["mean_"+key]) for key in ["iou", "precision", "recall", "f1"]]))
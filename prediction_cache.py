@@ -0,0 +1,99 @@
+"""
+On disk cache of model predictions, keyed by a fingerprint of the snapshot
+the predictions were made with, and a fingerprint of the input data.
+
+Evaluations and visualizations that run repeatedly on the same data (eg. the
+validation set) can then reuse the predictions for as long as the snapshot
+does not change. Once the snapshot changes, its fingerprint changes, so the
+old entries no longer match, and get removed on the next write.
+"""
+from __future__ import print_function, division
+import os
+import glob
+import hashlib
+import numpy as np
+
+
+# ==============================================================================
+#                                                                   FINGERPRINTS
+# ==============================================================================
+def snapshot_fingerprint(snapshot_file):
+    """ Returns a hash of a snapshot, or None if the snapshot does not exist.
+        The `.index` file of a checkpoint holds a checksum of every saved
+        tensor, so hashing it is cheap, but still changes whenever any of the
+        weights do. """
+    index_file = snapshot_file + ".index"
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, mode="rb") as fileObj:
+        return hashlib.sha1(fileObj.read()).hexdigest()[:16]
+
+
+def array_fingerprint(X):
+    """ Returns a hash of the contents, shape and dtype of an array """
+    X = np.ascontiguousarray(X)
+    h = hashlib.sha1(str((X.shape, X.dtype.str)).encode("utf-8"))
+    h.update(X.data)
+    return h.hexdigest()[:16]
+
+
+# ==============================================================================
+#                                                               PREDICTION_CACHE
+# ==============================================================================
+class PredictionCache(object):
+    """ Stores predictions as `.npy` files in `cache_dir`. Masks are stored as
+        uint8, and probabilities of the road class as float16, to keep the
+        files compact.
+
+    Examples:
+        cache = PredictionCache(os.path.join(model.model_dir, "pred_cache"))
+        preds = cache.get(model.best_snapshot_file, X_valid, kind="preds")
+        if preds is None:
+            preds = model.predict(X_valid)
+            cache.put(model.best_snapshot_file, X_valid, preds, kind="preds")
+    """
+    dtypes = {"preds": np.uint8, "probs": np.float16}
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def file(self, snapshot_key, data_key, kind):
+        return os.path.join(self.cache_dir, "{}_{}_{}.npy".format(snapshot_key, data_key, kind))
+
+    def get(self, snapshot_file, X, kind="preds"):
+        """ Returns the cached predictions, or None if there are none for the
+            current state of the snapshot """
+        snapshot_key = snapshot_fingerprint(snapshot_file)
+        if snapshot_key is None:
+            return None
+        file = self.file(snapshot_key, array_fingerprint(X), kind)
+        if os.path.exists(file):
+            return np.load(file, mmap_mode="r")
+        return None
+
+    def put(self, snapshot_file, X, preds, kind="preds"):
+        """ Caches the predictions made on X, and removes entries made with
+            other versions of the same snapshot file """
+        snapshot_key = snapshot_fingerprint(snapshot_file)
+        if snapshot_key is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Remove stale entries of previous versions of this snapshot
+        for file in glob.glob(os.path.join(self.cache_dir, "*.npy")):
+            if os.path.basename(file).split("_")[0] != snapshot_key and self.snapshot_of(file) == snapshot_file:
+                os.remove(file)
+                os.remove(file + ".src")
+
+        file = self.file(snapshot_key, array_fingerprint(X), kind)
+        np.save(file, np.asarray(preds).astype(self.dtypes[kind]))
+        with open(file + ".src", mode="w") as textFile:
+            textFile.write(snapshot_file)
+
+    def snapshot_of(self, file):
+        """ Returns the snapshot file that a cache entry was created from """
+        if not os.path.exists(file + ".src"):
+            return None
+        with open(file + ".src", mode="r") as textFile:
+            return textFile.read()
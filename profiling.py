@@ -0,0 +1,79 @@
+"""
+Captures full traces of individual `session.run()` calls, to see which ops
+the time and memory of a step go to.
+
+Each trace is saved as a Chrome trace file (open it at chrome://tracing),
+and a table of the most expensive ops is printed.
+"""
+from __future__ import print_function, division
+import os
+import json
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+# ==============================================================================
+#                                                                      TRACE_RUN
+# ==============================================================================
+def trace_run(session, fetches, feed_dict, trace_file, n_top=20, title=None):
+    """ Runs the fetches with full tracing turned on, saves the Chrome trace
+        to `trace_file`, prints the `n_top` ops that took the most time and
+        memory, and returns the results of the run. """
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    results = session.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+    save_chrome_trace(run_metadata, trace_file)
+    stats = op_stats(run_metadata)
+    with open(os.path.splitext(trace_file)[0] + "_ops.json", mode="w") as fileObj:
+        json.dump(stats, fileObj, indent=1)
+    print_top_ops(stats, n_top=n_top, title=title)
+    print("Saved trace to: \n- {}".format(trace_file))
+    return results
+
+
+def save_chrome_trace(run_metadata, file):
+    """ Saves the step stats of a traced run as a Chrome trace file """
+    pardir = os.path.dirname(file)
+    if pardir != "" and not os.path.exists(pardir):
+        os.makedirs(pardir)
+    trace = timeline.Timeline(step_stats=run_metadata.step_stats)
+    with open(file, mode="w") as fileObj:
+        fileObj.write(trace.generate_chrome_trace_format(show_memory=True))
+
+
+# ==============================================================================
+#                                                                       OP_STATS
+# ==============================================================================
+def op_stats(run_metadata):
+    """ Returns a list of dicts with the "name", "op" (type), "device",
+        "micros" (wall time) and "bytes" (memory allocated for its outputs)
+        of each op executed in a traced run """
+    stats = []
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node in dev_stats.node_stats:
+            label = node.timeline_label
+            op = label.split("=", 1)[1].split("(")[0].strip() if "=" in label else node.node_name
+            n_bytes = sum(output.tensor_description.allocation_description.requested_bytes for output in node.output)
+            stats.append({
+                "name": node.node_name,
+                "op": op,
+                "device": dev_stats.device,
+                "micros": node.all_end_rel_micros,
+                "bytes": n_bytes,
+                })
+    return stats
+
+
+def print_top_ops(stats, n_top=20, title=None):
+    """ Prints the ops that took the most time, and the most memory """
+    total_micros = max(sum(s["micros"] for s in stats), 1)
+    template = "{:<60} {:<20} {:>10} {:>7} {:>10}"
+    print("="*70)
+    print("PROFILE" + ("" if title is None else ": " + title))
+    for key, heading in [("micros", "TOP OPS BY TIME"), ("bytes", "TOP OPS BY MEMORY")]:
+        print("-"*70 + "\n" + heading)
+        print(template.format("NAME", "OP", "TIME(ms)", "TIME%", "MEM(MB)"))
+        for s in sorted(stats, key=lambda s: s[key], reverse=True)[:n_top]:
+            print(template.format(s["name"][-60:], s["op"][:20], "{:0.3f}".format(s["micros"]/1000), "{:0.1f}".format(100*s["micros"]/total_micros), "{:0.2f}".format(s["bytes"]/1e6)))
+    print("="*70)
@@ -0,0 +1,169 @@
+"""
+Post training quantization of a frozen segmentation graph (created by
+`export_graph.py`). Rewrites the graph to use 8 bit weights, and 8 bit
+activations for the ops that support it, calibrating the activation ranges
+on a sample of the training data.
+
+It reports the IoU on the validation split and the latency of the graph
+before and after quantization.
+
+Example:
+    python quantize.py models/mymodel/frozen_graph.pb -d data_299x299.pickle
+"""
+from __future__ import print_function, division
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from base import FrozenSegmentationModel
+from data_processing import pickle2obj
+from metrics import confusion_matrix, iou_score
+
+
+INPUTS = ["inputs/X"]
+OUTPUTS = ["preds", "probs"]
+TRANSFORMS = [
+    "add_default_attributes",
+    "remove_nodes(op=Identity, op=CheckNumerics)",
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "quantize_weights",
+    "quantize_nodes",
+    "sort_by_execution_order",
+    ]
+
+
+# ==============================================================================
+#                                                                 LOAD_GRAPH_DEF
+# ==============================================================================
+def load_graph_def(file):
+    """ Loads a GraphDef (*.pb) file """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(file, "rb") as file_obj:
+        graph_def.ParseFromString(file_obj.read())
+    return graph_def
+
+
+# ==============================================================================
+#                                                         CALIBRATE_REQUANT_RANGES
+# ==============================================================================
+def calibrate_requant_ranges(graph_def, X, batch_size=32):
+    """ Given a graph that went through the `quantize_nodes` transform, it
+        runs the calibration images X through it, and records the overall
+        min and max of each of the `RequantizationRange` ops (which otherwise
+        get calculated dynamically for every batch).
+
+        Returns a dictionary {op_name: (min, max)}
+    """
+    names = [node.name for node in graph_def.node if node.op == "RequantizationRange"]
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+        x = graph.get_tensor_by_name("inputs/X:0")
+        fetches = [(graph.get_tensor_by_name(name+":0"), graph.get_tensor_by_name(name+":1")) for name in names]
+
+    ranges = {name: (np.inf, -np.inf) for name in names}
+    with tf.Session(graph=graph) as session:
+        for i in range(0, len(X), batch_size):
+            results = session.run(fetches, feed_dict={x: X[i: i+batch_size]})
+            for name, (low, high) in zip(names, results):
+                ranges[name] = (min(ranges[name][0], low), max(ranges[name][1], high))
+    return ranges
+
+
+# ==============================================================================
+#                                                  FREEZE_REQUANTIZATION_RANGES
+# ==============================================================================
+def freeze_requantization_ranges(graph_def, ranges):
+    """ Replaces the dynamically calculated ranges fed into each `Requantize`
+        op with constants of the calibrated ranges, and prunes away the
+        `RequantizationRange` ops that are no longer needed.
+    """
+    output_graph_def = tf.GraphDef()
+    for node in graph_def.node:
+        output_graph_def.node.extend([node])
+
+    for name, (low, high) in ranges.items():
+        for suffix, value in [("min", low), ("max", high)]:
+            const = tf.NodeDef()
+            const.op = "Const"
+            const.name = "{}/frozen_{}".format(name, suffix)
+            const.attr["dtype"].type = tf.float32.as_datatype_enum
+            const.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(float(value), tf.float32))
+            output_graph_def.node.extend([const])
+
+    for node in output_graph_def.node:
+        if node.op != "Requantize":
+            continue
+        for i in [3, 4]:
+            source = node.input[i].split(":")[0]
+            if source in ranges:
+                node.input[i] = "{}/frozen_{}".format(source, "min" if i == 3 else "max")
+
+    output_graph_def.versions.CopyFrom(graph_def.versions)
+    return tf.graph_util.extract_sub_graph(output_graph_def, OUTPUTS + ["inputs/is_training"])
+
+
+# ==============================================================================
+#                                                              QUANTIZE_GRAPH_DEF
+# ==============================================================================
+def quantize_graph_def(graph_def, X_calib, batch_size=32):
+    """ Returns an 8 bit version of the frozen `graph_def`, with activation
+        ranges calibrated on the images `X_calib`. """
+    quantized = TransformGraph(graph_def, INPUTS, OUTPUTS, TRANSFORMS)
+    ranges = calibrate_requant_ranges(quantized, X_calib, batch_size=batch_size)
+    print("Calibrated {} requantization ranges".format(len(ranges)))
+    return freeze_requantization_ranges(quantized, ranges)
+
+
+# ==============================================================================
+#                                                           EVALUATE_FROZEN_GRAPH
+# ==============================================================================
+def evaluate_frozen_graph(graph_file, X, Y, batch_size=32, n_warmup=2):
+    """ Returns the IoU of the road class on X, Y, and the mean latency
+        (in seconds) per batch of `batch_size` images. """
+    model = FrozenSegmentationModel(graph_file)
+    with model.create_session() as session:
+        # Warmup runs, so that one-off setup costs are not timed
+        for i in range(n_warmup):
+            model.predict_in_session(X[:batch_size], session=session, batch_size=batch_size, verbose=False)
+
+        t0 = time.time()
+        preds = model.predict_in_session(X, session=session, batch_size=batch_size, verbose=False)
+        latency = (time.time()-t0)/np.ceil(len(X)/batch_size)
+
+    iou = iou_score(confusion_matrix(Y, preds, n_classes=model.n_classes), class_id=1)
+    return iou, latency
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description="Quantize a frozen segmentation graph to 8 bits")
+    p.add_argument("graph", type=str, help="Path to the frozen graph file to quantize")
+    p.add_argument("-d", "--data", type=str, default="data", help="Path to the pickled data file")
+    p.add_argument("-v", "--n_valid",type=int, default=31, help="Num samples set aside for validation set (same as used in training)")
+    p.add_argument("-c", "--n_calib", type=int, default=100, help="Num training samples to calibrate the activation ranges on")
+    p.add_argument("-b", "--batch_size", type=int, default=8, help="Batch size")
+    p.add_argument("-s", "--saveto", type=str, default=None, help="Path to save quantized graph to. Defaults to the input path with a `_int8` suffix")
+    opt = p.parse_args()
+    saveto = opt.saveto if opt.saveto is not None else os.path.splitext(opt.graph)[0] + "_int8.pb"
+
+    # Same validation split as train.py
+    data = pickle2obj(opt.data)
+    X_valid, Y_valid = data["X_train"][:opt.n_valid], data["Y_train"][:opt.n_valid]
+    X_calib = data["X_train"][opt.n_valid:opt.n_valid+opt.n_calib]
+
+    graph_def = load_graph_def(opt.graph)
+    quantized = quantize_graph_def(graph_def, X_calib, batch_size=opt.batch_size)
+    with tf.gfile.GFile(saveto, "wb") as file_obj:
+        file_obj.write(quantized.SerializeToString())
+    print("Saved quantized graph to: \n- {}".format(saveto))
+
+    print("EVALUATING ON {} VALIDATION SAMPLES".format(len(X_valid)))
+    template = "{:<10} IoU: {: 3.4f}  LATENCY: {: 8.2f} ms/batch ({:0.2f} ms/img)"
+    for label, file in [("float32", opt.graph), ("int8", saveto)]:
+        iou, latency = evaluate_frozen_graph(file, X_valid, Y_valid, batch_size=opt.batch_size)
+        print(template.format(label, iou, latency*1000, latency*1000/opt.batch_size))
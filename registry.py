@@ -0,0 +1,94 @@
+"""
+Process wide registry of warm sessions for loaded models, so that repeated
+calls to `model.predict()` and `model.evaluate()` without a session do not
+pay for creating a session and restoring a snapshot every time.
+"""
+from __future__ import print_function, division
+import os
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+
+
+# ==============================================================================
+#                                                                SNAPSHOT_MTIME
+# ==============================================================================
+def snapshot_mtime(snapshot_file):
+    """ Returns the modification time of a snapshot, or None if the snapshot
+        does not exist """
+    for file in [snapshot_file + ".index", snapshot_file]:
+        if os.path.exists(file):
+            return os.path.getmtime(file)
+    return None
+
+
+# ==============================================================================
+#                                                               SESSION_REGISTRY
+# ==============================================================================
+class SessionRegistry(object):
+    """ Keeps sessions with the weights of models already loaded, keyed by
+        (model name, architecture, snapshot file).
+
+        - A session is reloaded if the snapshot file changed since it was
+          loaded, or if the model's graph was rebuilt.
+        - The least recently used sessions are closed once there are more
+          than `max_sessions`, or once the weights of all loaded sessions take
+          more than `max_bytes` (activations are not counted).
+    """
+    def __init__(self, max_bytes=4e9, max_sessions=8):
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict() # Least recently used first
+        self.lock = threading.Lock()
+
+    def get_session(self, model, best=False):
+        """ Returns a session with the snapshot of `model` loaded """
+        snapshot_file = model.best_snapshot_file if best else model.snapshot_file
+        key = (model.model_dir, type(model).__name__, snapshot_file)
+        mtime = snapshot_mtime(snapshot_file)
+
+        with self.lock:
+            entry = self.sessions.pop(key, None)
+            if entry is not None and (entry["graph"] is not model.graph or entry["mtime"] != mtime):
+                print("Reloading changed snapshot: \n- ", snapshot_file)
+                entry["session"].close()
+                entry = None
+
+            if entry is None:
+                session = tf.Session(graph=model.graph)
+                model.initialize_vars(session, best=best)
+                entry = {"session": session, "graph": model.graph, "mtime": mtime, "n_bytes": graph_variables_bytes(model.graph)}
+
+            self.sessions[key] = entry
+            self.evict()
+            return entry["session"]
+
+    def evict(self):
+        """ Closes least recently used sessions until within the limits.
+            The most recently used session is always kept. """
+        while len(self.sessions) > 1 and (len(self.sessions) > self.max_sessions or self.n_bytes > self.max_bytes):
+            key, entry = self.sessions.popitem(last=False)
+            entry["session"].close()
+
+    def close(self, model=None):
+        """ Closes the sessions of `model`, or all sessions if None """
+        with self.lock:
+            for key in list(self.sessions.keys()):
+                if model is None or key[0] == model.model_dir:
+                    self.sessions.pop(key)["session"].close()
+
+    @property
+    def n_bytes(self):
+        return sum(entry["n_bytes"] for entry in self.sessions.values())
+
+
+def graph_variables_bytes(graph):
+    """ Returns the num of bytes taken by the global variables of a graph """
+    with graph.as_default():
+        variables = tf.global_variables()
+    return sum(int(np.prod(v.shape.as_list()))*v.dtype.base_dtype.size for v in variables)
+
+
+# Shared by all models in the process
+session_registry = SessionRegistry()
@@ -0,0 +1,90 @@
+"""
+Tools for spending more of the training steps on the samples the model still
+finds hard, instead of weighting every training sample equally.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+
+# ==============================================================================
+#                                                               DIFFICULTY_INDEX
+# ==============================================================================
+class DifficultyIndex(object):
+    """ Keeps track of the recent loss and IoU of each training sample, and
+        draws the order of samples for an epoch, weighted by difficulty.
+
+        The difficulty of a sample is an exponential moving average of its
+        loss. Samples that have not been seen yet get the highest difficulty
+        seen so far, so that they get visited early.
+
+        Sampling probabilities are proportional to
+        `difficulty**(1/temperature)`, mixed with a uniform distribution, so
+        that every sample has a probability of at least `floor/n_samples`.
+        A high temperature tends towards uniform sampling, and a low one
+        focuses on the hardest samples.
+
+    Examples:
+        index = DifficultyIndex(n_samples=len(X_train))
+        order = index.sample_order(temperature=1.0, floor=0.1)
+        for i in range(n_batches):
+            ids = order[i*batch_size: (i+1)*batch_size]
+            losses, ious = ... # train on X_train[ids]
+            index.update(ids, losses, ious)
+    """
+    def __init__(self, n_samples, momentum=0.5):
+        self.n_samples = n_samples
+        self.momentum = momentum    # Weight given to the previous value
+        self.loss = np.full(n_samples, np.nan, dtype=np.float32)
+        self.iou = np.full(n_samples, np.nan, dtype=np.float32)
+        self.n_seen = np.zeros(n_samples, dtype=np.int32)
+
+    def update(self, ids, losses, ious):
+        """ Records the losses and IoUs of the samples with the given ids.
+            Ids can repeat (samples are drawn with replacement), in which
+            case each occurrence is folded into the average in order. """
+        ids = np.asarray(ids)
+        if len(np.unique(ids)) == len(ids):
+            # No repeats (eg. uniform sampling), so update them all at once
+            for history, values in [(self.loss, losses), (self.iou, ious)]:
+                old = history[ids]
+                history[ids] = np.where(np.isnan(old), values, self.momentum*old + (1-self.momentum)*np.asarray(values))
+            self.n_seen[ids] += 1
+            return
+        for i, loss, iou in zip(ids, losses, ious):
+            for history, value in [(self.loss, loss), (self.iou, iou)]:
+                old = history[i]
+                history[i] = value if np.isnan(old) else self.momentum*old + (1-self.momentum)*value
+            self.n_seen[i] += 1
+
+    def difficulty(self):
+        """ Returns the difficulty of each sample """
+        seen = ~np.isnan(self.loss)
+        if not np.any(seen):
+            return np.ones(self.n_samples, dtype=np.float32)
+        return np.where(seen, self.loss, np.nanmax(self.loss))
+
+    def probabilities(self, temperature=1.0, floor=0.1):
+        """ Returns the probability of drawing each sample """
+        assert temperature > 0, "temperature must be positive"
+        assert 0 <= floor <= 1, "floor must be in the range [0, 1]"
+        difficulty = np.maximum(self.difficulty().astype(np.float64), 1e-12)
+        weights = (difficulty/difficulty.max())**(1.0/temperature)
+        probs = weights/weights.sum()
+        return (1-floor)*probs + floor/self.n_samples
+
+    def sample_order(self, temperature=1.0, floor=0.1, n=None):
+        """ Returns `n` (default n_samples) sample ids, drawn with replacement
+            weighted by difficulty """
+        n = self.n_samples if n is None else n
+        probs = self.probabilities(temperature=temperature, floor=floor)
+        return np.random.choice(self.n_samples, size=n, replace=True, p=probs)
+
+    def summary(self):
+        """ Returns a dictionary of summary statistics of the index """
+        seen = self.n_seen > 0
+        return {
+            "n_seen": int(seen.sum()),
+            "mean_loss": float(np.mean(self.loss[seen])) if np.any(seen) else None,
+            "mean_iou": float(np.nanmean(self.iou[seen])) if np.any(seen) else None,
+            "max_count": int(self.n_seen.max()),
+            }
@@ -0,0 +1,155 @@
+"""
+Segments all the images in a directory (or matching a glob pattern), and
+saves the predicted masks (or overlays of the predictions on the images) to
+an output directory.
+
+Images are decoded and resized by a pool of worker threads while the
+previous batch goes through the model, and the outputs are written by a
+separate pool of writer threads. Images whose outputs already exist are
+skipped, so an interrupted run can be resumed by running it again.
+
+Example:
+    python segment_dir.py mymodel --arc SimpleSegA -d 128 -i "data/testing/image_2/*.png" -o preds
+"""
+from __future__ import print_function, division
+import os
+import glob
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import PIL
+from PIL import Image
+
+from architectures import load_model, add_model_args
+from base import pretty_time
+from viz import vizseg
+
+
+# ==============================================================================
+#                                                                    LIST_IMAGES
+# ==============================================================================
+def list_images(path, extensions=(".png", ".jpg", ".jpeg")):
+    """ Given a directory or a glob pattern, returns a sorted list of the
+        image files """
+    if os.path.isdir(path):
+        files = [os.path.join(path, f) for f in os.listdir(path)]
+    else:
+        files = glob.glob(path)
+    return sorted(f for f in files if os.path.splitext(f)[1].lower() in extensions)
+
+
+def output_file(file, output_dir, overlay=False):
+    """ Path of the output file for an input image file """
+    name = os.path.splitext(os.path.basename(file))[0]
+    return os.path.join(output_dir, name + ("_overlay.jpg" if overlay else ".png"))
+
+
+# ==============================================================================
+#                                                                 DECODE / WRITE
+# ==============================================================================
+def decode(file, dims):
+    """ Returns the original image array, and a copy resized to `dims` """
+    img = PIL.Image.open(file).convert("RGB")
+    return np.asarray(img), np.asarray(img.resize(dims, resample=PIL.Image.BILINEAR))
+
+
+def write(img, pred, file, overlay=False):
+    """ Saves the prediction, resized to the original image size, either as a
+        mask (0=non-road, 255=road), or overlayed on top of the image.
+        It is written to a temporary file that is then moved into place, so
+        an interrupted run never leaves a partial output that gets skipped
+        as done when the run is resumed. """
+    height, width = img.shape[:2]
+    pred = PIL.Image.fromarray(pred.astype(np.uint8)).resize((width, height), resample=PIL.Image.NEAREST)
+    tmp_file = file + ".tmp"
+    if overlay:
+        pred = np.asarray(pred)
+        vizseg(img, label=np.zeros_like(pred), pred=pred, saveto=tmp_file)
+    else:
+        PIL.Image.fromarray((np.asarray(pred)==1).astype(np.uint8)*255).save(tmp_file, "PNG")
+    os.replace(tmp_file, file)
+
+
+# ==============================================================================
+#                                                                    SEGMENT_DIR
+# ==============================================================================
+def segment_files(files, model, session, output_dir, batch_size=16, n_decoders=4, n_writers=4, overlay=False):
+    """ Segments all the image files, and saves the outputs to `output_dir`.
+        Returns a dictionary of throughput stats. """
+    dims = (model.img_width, model.img_height)
+    decode_pool = ThreadPool(n_decoders)
+    write_pool = ThreadPool(n_writers)
+    batches = [files[i: i+batch_size] for i in range(0, len(files), batch_size)]
+    max_pending_writes = 2*n_writers
+    pending_writes = []
+    t_infer = 0.0
+    t_wait_decode = 0.0
+    t0 = time.time()
+
+    # Decode the next batch while the current one goes through the model
+    next_decoded = decode_pool.map_async(lambda f: decode(f, dims), batches[0]) if batches else None
+    for i, batch in enumerate(batches):
+        t = time.time()
+        decoded = next_decoded.get()
+        t_wait_decode += time.time() - t
+        if i+1 < len(batches):
+            next_decoded = decode_pool.map_async(lambda f: decode(f, dims), batches[i+1])
+
+        t = time.time()
+        X = np.array([scaled for img, scaled in decoded])
+        preds = model.predict_in_session(X, session=session, batch_size=len(X), verbose=False)
+        t_infer += time.time() - t
+
+        for (img, scaled), pred, file in zip(decoded, preds, batch):
+            pending_writes.append(write_pool.apply_async(write, (img, pred, output_file(file, output_dir, overlay), overlay)))
+
+        # Limit num of batches waiting to be written, to bound memory
+        while len(pending_writes) > max_pending_writes*batch_size:
+            pending_writes.pop(0).get()
+
+        n_done = min((i+1)*batch_size, len(files))
+        print("\r{} {}/{} images ({:0.2f} images/sec)".format(pretty_time(time.time()-t0), n_done, len(files), n_done/(time.time()-t0)), end="")
+
+    for result in pending_writes:
+        result.get()
+    decode_pool.close()
+    write_pool.close()
+    print("")
+
+    duration = time.time()-t0
+    return {
+        "n_images": len(files),
+        "duration": duration,
+        "images_per_sec": len(files)/max(duration, 1e-9),
+        "inference_time": t_infer,
+        "decode_wait_time": t_wait_decode,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description="Segment all images in a directory")
+    add_model_args(p)
+    p.add_argument("-i", "--input", type=str, help="Directory of images, or glob pattern of image files")
+    p.add_argument("-o", "--output_dir", type=str, help="Directory to save outputs to")
+    p.add_argument("--overlay", action="store_true", help="Save predictions overlayed on the images, instead of masks")
+    p.add_argument("-b", "--batch_size", type=int, default=16, help="Batch size")
+    p.add_argument("--n_decoders", type=int, default=4, help="Num threads decoding and resizing images")
+    p.add_argument("--n_writers", type=int, default=4, help="Num threads writing outputs")
+    opt = p.parse_args()
+
+    files = list_images(opt.input)
+    todo = [f for f in files if not os.path.exists(output_file(f, opt.output_dir, opt.overlay))]
+    print("Found {} images ({} already done)".format(len(files), len(files)-len(todo)))
+    if not os.path.exists(opt.output_dir):
+        os.makedirs(opt.output_dir)
+
+    model = load_model(opt.arc, name=opt.name, img_dim=opt.img_dim, graph=opt.graph)
+
+    with model.create_session() as session:
+        model.initialize_vars(session=session, best=opt.best)
+        stats = segment_files(todo, model, session, opt.output_dir, batch_size=opt.batch_size, n_decoders=opt.n_decoders, n_writers=opt.n_writers, overlay=opt.overlay)
+
+    print("Segmented {n_images} images in {duration:0.2f} s ({images_per_sec:0.2f} images/sec)".format(**stats))
+    print("- Inference time:     {:0.2f} s".format(stats["inference_time"]))
+    print("- Waiting for decode: {:0.2f} s".format(stats["decode_wait_time"]))
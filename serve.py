@@ -0,0 +1,229 @@
+"""
+Local inference server. Loads a trained model once, and keeps a single warm
+session to serve segmentation masks over HTTP.
+
+Concurrent requests are coalesced into batches. A batch is run as soon as
+it is full, or once the oldest request in it has waited `--latency_ms`.
+
+Endpoints:
+    POST /predict   Body is an encoded image (jpg, png, ...). Returns the
+                    predicted mask as a png image of the same size as the
+                    input image (0=non-road, 255=road).
+    GET  /metrics   Returns JSON with batch size, queue depth and latency
+                    statistics.
+
+Example:
+    python serve.py mymodel --arc SimpleSegA -d 128 --port 8000
+    curl --data-binary @frame.png localhost:8000/predict > mask.png
+"""
+from __future__ import print_function, division
+import io
+import json
+import time
+import threading
+import collections
+import numpy as np
+import PIL
+from PIL import Image
+from architectures import load_model, add_model_args
+
+try:
+    import queue
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError: # python 2.7
+    import Queue as queue
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+# ==============================================================================
+#                                                                 MICRO_BATCHER
+# ==============================================================================
+class MicroBatcher(object):
+    """ Collects single image requests from many threads into batches, and
+        runs them through the model in one background thread that owns the
+        session.
+    """
+    def __init__(self, model, session, max_batch_size=16, latency_ms=10, max_queue=256):
+        self.model = model
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.latency = latency_ms/1000.
+        self.requests = queue.Queue(maxsize=max_queue)
+
+        # Metrics
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_rejected = 0
+        self.batch_sizes = collections.deque(maxlen=1000)
+        self.latencies = collections.deque(maxlen=1000)
+        self.inference_times = collections.deque(maxlen=1000)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def predict(self, img):
+        """ Given a single image array of shape [height, width, 3] already
+            resized to the model's input size, it blocks until the
+            prediction is ready and returns it.
+            Raises queue.Full if too many requests are waiting.
+        """
+        request = {"img": img, "t": time.time(), "done": threading.Event()}
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            with self.lock:
+                self.n_rejected += 1
+            raise
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["pred"]
+
+    def next_batch(self):
+        """ Blocks for the first request, then gathers more until the batch
+            is full or the latency window of the first request runs out """
+        batch = [self.requests.get()]
+        deadline = batch[0]["t"] + self.latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            t0 = time.time()
+            try:
+                X = np.array([request["img"] for request in batch])
+                preds = self.model.predict_in_session(X, session=self.session, batch_size=len(batch), verbose=False)
+                preds = preds.reshape([len(batch), self.model.img_height, self.model.img_width])
+                for request, pred in zip(batch, preds):
+                    request["pred"] = pred
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            t1 = time.time()
+
+            with self.lock:
+                self.n_batches += 1
+                self.n_requests += len(batch)
+                self.batch_sizes.append(len(batch))
+                self.inference_times.append(t1-t0)
+                for request in batch:
+                    self.latencies.append(t1-request["t"])
+            for request in batch:
+                request["done"].set()
+
+    def metrics(self):
+        """ Returns a dictionary of the serving statistics """
+        def percentiles(x):
+            if len(x) == 0:
+                return None
+            p50, p90, p99 = np.percentile(np.array(x)*1000, [50, 90, 99])
+            return {"p50_ms": p50, "p90_ms": p90, "p99_ms": p99}
+
+        with self.lock:
+            return {
+                "n_requests": self.n_requests,
+                "n_batches": self.n_batches,
+                "n_rejected": self.n_rejected,
+                "queue_depth": self.requests.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else None,
+                "latency": percentiles(self.latencies),
+                "inference_time": percentiles(self.inference_times),
+                }
+
+
+# ==============================================================================
+#                                                               REQUEST HANDLER
+# ==============================================================================
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def create_handler(batcher):
+    """ Creates a request handler class that sends work to `batcher` """
+    img_dims = (batcher.model.img_width, batcher.model.img_height)
+
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, code, obj):
+            self.send(code, json.dumps(obj).encode("utf-8"), "application/json")
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self.send_json(200, batcher.metrics())
+            else:
+                self.send_json(404, {"error": "unknown path"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_json(404, {"error": "unknown path"})
+                return
+            try:
+                n_bytes = int(self.headers["Content-Length"])
+                img = PIL.Image.open(io.BytesIO(self.rfile.read(n_bytes))).convert("RGB")
+            except Exception as e:
+                self.send_json(400, {"error": "could not decode image: {}".format(e)})
+                return
+
+            try:
+                pred = batcher.predict(np.asarray(img.resize(img_dims, resample=PIL.Image.BILINEAR)))
+            except queue.Full:
+                self.send_json(503, {"error": "queue is full"})
+                return
+            except Exception as e:
+                self.send_json(500, {"error": "prediction failed: {}".format(e)})
+                return
+
+            # Return the mask at the size of the input image
+            mask = PIL.Image.fromarray((pred == 1).astype(np.uint8)*255)
+            mask = mask.resize(img.size, resample=PIL.Image.NEAREST)
+            buffer = io.BytesIO()
+            mask.save(buffer, "PNG")
+            self.send(200, buffer.getvalue(), "image/png")
+
+        def log_message(self, format, *args):
+            pass # Do not print a line for every request
+
+    return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description="Serve predictions of a model over HTTP")
+    add_model_args(p)
+    p.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    p.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    p.add_argument("-b", "--batch_size", type=int, default=16, help="Max number of requests per batch")
+    p.add_argument("--latency_ms", type=float, default=10, help="Max time (ms) a request waits for others to join its batch")
+    p.add_argument("--max_queue", type=int, default=256, help="Max number of waiting requests before rejecting new ones")
+    opt = p.parse_args()
+
+    model = load_model(opt.arc, name=opt.name, img_dim=opt.img_dim, graph=opt.graph)
+    with model.create_session() as session:
+        model.initialize_vars(session=session, best=opt.best)
+        batcher = MicroBatcher(model, session, max_batch_size=opt.batch_size, latency_ms=opt.latency_ms, max_queue=opt.max_queue)
+        server = ThreadingHTTPServer((opt.host, opt.port), create_handler(batcher))
+        print("Serving {} on http://{}:{}".format(opt.name, opt.host, opt.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down")
+        server.server_close()
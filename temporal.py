@@ -0,0 +1,87 @@
+"""
+Tools for exploiting the redundancy between consecutive video frames, by only
+running the model on keyframes, and reusing the previous prediction for the
+frames in between.
+"""
+from __future__ import print_function, division
+import numpy as np
+import cv2
+
+
+# ==============================================================================
+#                                                              KEYFRAME_SELECTOR
+# ==============================================================================
+class KeyframeSelector(object):
+    """ Decides which frames of a video the model should be run on.
+
+        A frame becomes a keyframe if it changed by more than `threshold`
+        from the last keyframe, or if `max_interval` frames have passed since
+        the last keyframe. Change is the mean absolute difference of
+        downsampled grayscale frames, scaled to the range 0-1.
+
+        If a `budget` is given (fraction of frames to run the model on),
+        then the threshold is adjusted as the video goes, so that the
+        fraction of keyframes over roughly the last `window` frames tracks
+        the budget. The threshold is kept within `threshold_range`, so it
+        can not run away when the budget is out of reach (eg. a budget
+        below `1/max_interval`).
+
+    Examples:
+        selector = KeyframeSelector(budget=0.25)
+        for frame in frames:
+            if selector.is_keyframe(frame):
+                pred = ... # run the model
+            # else: reuse previous pred
+        print(selector.inference_rate)
+    """
+    def __init__(self, threshold=0.02, max_interval=30, budget=None, small_dims=(64, 36), window=100, threshold_range=(1e-4, 1.0)):
+        assert budget is None or 0 < budget <= 1, "budget must be in the range (0, 1]"
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.budget = budget
+        self.small_dims = small_dims
+        self.adjust_rate = 1.05     # Multiplier used to nudge the threshold
+        self.window = window
+        self.threshold_range = threshold_range
+        self.recent_rate = budget   # Moving average of the keyframe rate
+        self.last_keyframe = None
+        self.since_keyframe = 0
+        self.n_frames = 0
+        self.n_keyframes = 0
+
+    def downsample(self, frame):
+        small = cv2.resize(frame, self.small_dims, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small.astype(np.float32)/255.
+
+    def is_keyframe(self, frame):
+        """ Returns True if the model should be run on this frame """
+        small = self.downsample(frame)
+        self.n_frames += 1
+        self.since_keyframe += 1
+
+        if self.last_keyframe is None or self.since_keyframe >= self.max_interval:
+            keyframe = True
+        else:
+            keyframe = np.mean(np.abs(small - self.last_keyframe)) > self.threshold
+
+        if keyframe:
+            self.last_keyframe = small
+            self.since_keyframe = 0
+            self.n_keyframes += 1
+
+        # Nudge the threshold towards the compute budget
+        if self.budget is not None:
+            self.recent_rate += (float(keyframe) - self.recent_rate)/self.window
+            if self.recent_rate > self.budget:
+                self.threshold *= self.adjust_rate
+            else:
+                self.threshold /= self.adjust_rate
+            self.threshold = float(np.clip(self.threshold, *self.threshold_range))
+        return keyframe
+
+    @property
+    def inference_rate(self):
+        """ Fraction of frames the model was run on so far """
+        return self.n_keyframes/max(self.n_frames, 1)
@@ -0,0 +1,118 @@
+"""
+Functions for running a model on images larger than its input size, by
+splitting them into overlapping tiles and blending the per-tile class
+probabilities back into a single full resolution map.
+
+Example:
+    tiles = extract_tiles(img, tile_size=299, stride=224, model_dims=(299, 299))
+    probs = model.predict_probs_in_session(tiles, session=session)
+    probs = blend_tiles(probs, img.shape, tile_size=299, stride=224)
+    pred = probs.argmax(axis=-1)
+"""
+from __future__ import print_function, division
+import numpy as np
+import cv2
+
+
+# ==============================================================================
+#                                                                TILE_POSITIONS
+# ==============================================================================
+def tile_positions(length, tile_size, stride):
+    """ Returns the start offsets of tiles of `tile_size` along an axis of
+        `length`, spaced `stride` apart. The last tile is aligned with the end
+        of the axis, so the whole axis is always covered.
+        If the axis is shorter than a tile, a single tile at 0 is returned.
+    """
+    if length <= tile_size:
+        return [0]
+    positions = list(range(0, length - tile_size + 1, stride))
+    if positions[-1] != length - tile_size:
+        positions.append(length - tile_size)
+    return positions
+
+
+def tile_grid(img_shape, tile_size, stride):
+    """ Returns a list of (row, col) offsets of all tiles for an image """
+    height, width = img_shape[:2]
+    return [(y, x) for y in tile_positions(height, tile_size, stride) for x in tile_positions(width, tile_size, stride)]
+
+
+# ==============================================================================
+#                                                                 EXTRACT_TILES
+# ==============================================================================
+def extract_tiles(img, tile_size, stride, model_dims=None):
+    """ Splits an image of shape [height, width, n_channels] into overlapping
+        square tiles of `tile_size`. Images smaller than a tile are padded at
+        the bottom/right edges (by reflection).
+
+    Args:
+        img:        (numpy array) of shape [height, width, n_channels]
+        tile_size:  (int) Side length of the tiles (in image pixels)
+        stride:     (int) Distance between neighbouring tiles. Overlap is
+                    `tile_size - stride`.
+        model_dims: (tuple or None) (width, height) of the model input. If
+                    it differs from the tile size, tiles get resized to it.
+
+    Returns: (numpy array)
+        Tiles of shape [n_tiles, model_height, model_width, n_channels]
+    """
+    img = pad_to_tile_size(img, tile_size)
+    tiles = np.array([img[y:y+tile_size, x:x+tile_size] for y, x in tile_grid(img.shape, tile_size, stride)])
+    if model_dims is not None and tuple(model_dims) != (tile_size, tile_size):
+        tiles = np.array([cv2.resize(tile, tuple(model_dims), interpolation=cv2.INTER_LINEAR) for tile in tiles])
+    return tiles
+
+
+def pad_to_tile_size(img, tile_size):
+    """ Pads the bottom/right edges of an image smaller than a tile """
+    pad_y = max(0, tile_size - img.shape[0])
+    pad_x = max(0, tile_size - img.shape[1])
+    if pad_y == 0 and pad_x == 0:
+        return img
+    pad_width = [(0, pad_y), (0, pad_x)] + [(0, 0)]*(img.ndim-2)
+    return np.pad(img, pad_width, mode="reflect")
+
+
+# ==============================================================================
+#                                                                   BLEND_TILES
+# ==============================================================================
+def blending_window(tile_size, min_weight=1e-3):
+    """ 2D weights that are highest at the centre of a tile and fall off
+        linearly towards its edges, so that the predictions near the
+        borders of a tile, which have the least context, count the least
+        where tiles overlap.
+    """
+    ramp = 1 - np.abs(2*(np.arange(tile_size)+0.5)/tile_size - 1)
+    ramp = np.maximum(ramp, min_weight)
+    return np.outer(ramp, ramp).astype(np.float32)
+
+
+def blend_tiles(tile_probs, img_shape, tile_size, stride):
+    """ Given the class probabilities predicted for each of the tiles created
+        by `extract_tiles()`, it blends them back into a single map covering
+        the original image.
+
+    Args:
+        tile_probs: (numpy array) of shape [n_tiles, h, w, n_classes]
+        img_shape:  (tuple) Shape of the original image
+        tile_size:  (int) Same value passed to `extract_tiles()`
+        stride:     (int) Same value passed to `extract_tiles()`
+
+    Returns: (numpy array)
+        Probabilities of shape [height, width, n_classes]
+    """
+    height, width = img_shape[:2]
+    padded_height, padded_width = max(height, tile_size), max(width, tile_size)
+    n_classes = tile_probs.shape[-1]
+    window = blending_window(tile_size)
+
+    total = np.zeros([padded_height, padded_width, n_classes], dtype=np.float32)
+    weights = np.zeros([padded_height, padded_width, 1], dtype=np.float32)
+    for probs, (y, x) in zip(tile_probs, tile_grid((padded_height, padded_width), tile_size, stride)):
+        if probs.shape[:2] != (tile_size, tile_size):
+            probs = cv2.resize(probs, (tile_size, tile_size), interpolation=cv2.INTER_LINEAR)
+            probs = probs.reshape(tile_size, tile_size, n_classes)
+        total[y:y+tile_size, x:x+tile_size] += probs * window[:, :, np.newaxis]
+        weights[y:y+tile_size, x:x+tile_size] += window[:, :, np.newaxis]
+
+    return (total/weights)[:height, :width]
@@ -10,6 +10,7 @@ import shutil  # for removing dirs
 from data_processing import create_data_dict, str2file, id2label, label2id, pickle2obj, obj2pickle, maybe_make_pardir
 from image_processing import create_augmentation_func_for_segmentation
 from architectures import arc
+from memory import MemoryTracker
 
 import argparse
 p = argparse.ArgumentParser()
@@ -20,15 +21,29 @@ p.add_argument("--pretrained_snapshot", type=str, default=None, help="Path to pr
 p.add_argument("-v", "--n_valid",type=int, default=31, help="Num samples to set aside for validation set")
 p.add_argument("-m", "--max_data", type=int, default=100000000, help="Max number of samples to use from training data. Useful for quickly testing a training reigeme")
 p.add_argument("-b", "--batch_size", type=int, default=32, help="Batch size")
+p.add_argument("--accum_steps", type=int, default=1, help="Num of batches to accumulate gradients over before each update (effective batch size = batch_size*accum_steps)")
 p.add_argument("-a", "--alpha", type=float, default=0.001, help="Learning rate alpha")
 p.add_argument("--dropout", type=float, default=0.0, help="Dropout rate (amount to drop)")
 p.add_argument("-n", "--n_epochs", type=int, default=1, help="Number of epochs")
 p.add_argument("-p", "--print_every", type=int, default=100, help="How often to print out feedback on training (in number of steps)")
 p.add_argument("-l", "--l2", type=float, default=None, help="Amount of L2 to apply")
 p.add_argument("-s", "--img_dim", type=int, default=32, help="Size of single dimension of image (assuming square image)")
+p.add_argument("--patience", type=int, default=None, help="Stop early if best_metric does not improve for this many epochs")
+p.add_argument("--min_delta", type=float, default=0.0, help="Minimum increase of best_metric that counts as an improvement for early stopping")
+p.add_argument("--time_budget", type=float, default=None, help="Wall-clock training budget in minutes. Stops before starting an epoch that would exceed it")
+p.add_argument("--checkpoint_steps", type=int, default=None, help="Save a resumable mid-epoch checkpoint every this many steps")
+p.add_argument("--checkpoint_mins", type=float, default=None, help="Save a resumable mid-epoch checkpoint every this many minutes")
+p.add_argument("--train_eval", type=str, default="subset", help="How to get train IoU/loss each epoch [subset, running]. 'running' reuses the stats of the training steps instead of an extra evaluation pass")
+p.add_argument("--train_eval_size", type=int, default=1000, help="Num train samples to evaluate on each epoch when --train_eval=subset")
+p.add_argument("--sampling", type=str, default="uniform", help="How to choose the samples of each epoch [uniform, hard]. 'hard' draws samples weighted by their recent loss")
+p.add_argument("--sampling_temp", type=float, default=1.0, help="Temperature of hard sampling. Lower focuses more on the hardest samples")
+p.add_argument("--sampling_floor", type=float, default=0.1, help="Fraction of probability spread uniformly over all samples in hard sampling")
+p.add_argument("--summary_every", type=int, default=10, help="Write step timings, throughput, loss and learning rate to tensorboard every this many steps")
+p.add_argument("--profile_steps", type=int, nargs="*", default=None, help="Global steps to capture a full trace of (saved to the model's profiles dir)")
 p.add_argument("--best_metric", type=str, default="valid_iou", help="The metric to use for evaluating best model")
 p.add_argument("--aug_func", type=str, default="a", help="Aug function to use [a, b]")
 p.add_argument("--dynamic", action='store_true', help="Toggle switch to turn on dynamic loading of data from raw image files")
+p.add_argument("--memory_report", action='store_true', help="Record the memory used by the data arrays, and the peak RSS of each phase, to memory_report.txt in the model dir")
 
 opt = p.parse_args()
 
@@ -40,6 +55,8 @@ print(("#"*70)+"\n"+"PREPARING DATA"+"\n"+("#"*70))
 
 MAX_DATA = opt.max_data
 N_VALID = opt.n_valid
+memory_tracker = MemoryTracker(enabled=opt.memory_report)
+memory_tracker.start_phase("load")
 
 print("DYNAMIC: ", opt.dynamic)
 if opt.dynamic:
@@ -132,11 +149,26 @@ def create_and_train_model(
         augmentation_func=None,
         best_evals_metric="valid_acc",
         viz_every=10,
+        accum_steps=1,
+        patience=None,
+        min_delta=0.0,
+        time_budget=None,
+        checkpoint_every_steps=None,
+        checkpoint_every_mins=None,
+        train_eval_mode="subset",
+        train_eval_size=1000,
+        sampling="uniform",
+        sampling_temperature=1.0,
+        sampling_floor=0.1,
+        profile_steps=None,
+        summary_every=10,
+        memory_tracker=None,
         ):
     print("\n"+("#"*70)+"\n"+"MODEL NAME = "+name+"\n"+("#"*70)+"\n")
     print("ALPHA: ", alpha)
     print("DROPOUT: ", dropout)
     print("BATCH SIZE: ", batch_size)
+    print("ACCUM STEPS: ", accum_steps)
     model_dir = os.path.join("models", name)
 
     # Check if the model already exists
@@ -169,11 +201,15 @@ def create_and_train_model(
     if pretrained_snapshot:
         kwargs["pretrained_snapshot"] = pretrained_snapshot
 
+    if memory_tracker is not None:
+        memory_tracker.start_phase("graph_build")
     model = ModelClass(**kwargs)
     model.create_graph()
+    if memory_tracker is not None:
+        memory_tracker.end_phase()
 
     # Train the model
-    model.train(data, alpha=alpha, dropout=dropout, n_epochs=n_epochs, batch_size=batch_size, print_every=print_every, augmentation_func=augmentation_func, viz_every=viz_every)
+    model.train(data, alpha=alpha, dropout=dropout, n_epochs=n_epochs, batch_size=batch_size, print_every=print_every, augmentation_func=augmentation_func, viz_every=viz_every, accum_steps=accum_steps, patience=patience, min_delta=min_delta, time_budget=time_budget, checkpoint_every_steps=checkpoint_every_steps, checkpoint_every_mins=checkpoint_every_mins, train_eval_mode=train_eval_mode, train_eval_size=train_eval_size, sampling=sampling, sampling_temperature=sampling_temperature, sampling_floor=sampling_floor, profile_steps=profile_steps, summary_every=summary_every, memory_tracker=memory_tracker)
     print("DONE TRAINING")
 
 
@@ -198,5 +234,19 @@ create_and_train_model(
         img_shape=(opt.img_dim, opt.img_dim),
         augmentation_func=aug_funcs[opt.aug_func],
         best_evals_metric=opt.best_metric,
-        viz_every=10
+        viz_every=10,
+        accum_steps=opt.accum_steps,
+        patience=opt.patience,
+        min_delta=opt.min_delta,
+        time_budget=None if opt.time_budget is None else opt.time_budget*60,
+        checkpoint_every_steps=opt.checkpoint_steps,
+        checkpoint_every_mins=opt.checkpoint_mins,
+        train_eval_mode=opt.train_eval,
+        train_eval_size=opt.train_eval_size,
+        sampling=opt.sampling,
+        sampling_temperature=opt.sampling_temp,
+        sampling_floor=opt.sampling_floor,
+        profile_steps=opt.profile_steps,
+        summary_every=opt.summary_every,
+        memory_tracker=memory_tracker,
         )
@@ -1,18 +1,29 @@
 from __future__ import print_function, division
 import os
-import distutils
+import time
+import threading
 import numpy as np
 import cv2
-from architectures import arc
+from architectures import load_model, add_model_args
+from tiling import extract_tiles, blend_tiles
+from temporal import KeyframeSelector
 
 import argparse
 p = argparse.ArgumentParser(description="Run a prediction on video")
-p.add_argument("name", type=str, help="model name")
-p.add_argument("--arc", type=str, help="model architecture")
-p.add_argument("-d", "--img_dim", type=int, default=299, help="image dimension (64, 128, 224, 299)")
+add_model_args(p)
 p.add_argument("-v", "--vid", type=str, help="Path to the video file to use")
 p.add_argument("-s", "--saveto", type=str, default="", help="path to save output video to")
-p.add_argument("--best", default=True, type=lambda x:bool(distutils.util.strtobool(x)), help="Use best snapshot? False uses latest snapshot")
+p.add_argument("--pipeline", action="store_true", help="Run decoding, preprocessing, inference and encoding concurrently in separate threads")
+p.add_argument("-b", "--batch_size", type=int, default=8, help="Num frames per inference batch in pipeline mode")
+p.add_argument("--queue_size", type=int, default=4, help="Max num of items waiting between pipeline stages")
+p.add_argument("--tiled", action="store_true", help="Segment full resolution frames as overlapping tiles, instead of squashing each frame to the model input size")
+p.add_argument("--tile_size", type=int, default=None, help="Side length of tiles in frame pixels (defaults to model input size). Tiles are resized to the model input size")
+p.add_argument("--overlap", type=int, default=64, help="Num pixels neighbouring tiles overlap by")
+p.add_argument("--stride", type=int, default=None, help="Distance between neighbouring tiles in pixels. Overrides --overlap")
+p.add_argument("--temporal", action="store_true", help="Only run the model on keyframes, and reuse the previous mask on near-static frames")
+p.add_argument("--change_threshold", type=float, default=0.02, help="Mean abs change (0-1) of downsampled frames since last keyframe that triggers a new keyframe")
+p.add_argument("--keyframe_interval", type=int, default=30, help="Max num of frames between keyframes")
+p.add_argument("--inference_budget", type=float, default=None, help="Fraction of frames to run the model on (0-1]. Adapts the change threshold to track it")
 # TODO: Add a `show` argument.
 opt = p.parse_args()
 
@@ -42,40 +53,213 @@ if out_video_path != "":
     out = cv2.VideoWriter(out_video_path,fourcc, 24.0, out_vid_dims)
 
 
+################################################################################
+#                                                      FRAME PRE/POST PROCESSING
+################################################################################
+def preprocess(image):
+    """ Returns the batch of model inputs for a frame. Either the frame
+        scaled to the input size of the model, or the tiles of the full
+        resolution frame in tiled mode. In temporal mode, it returns None
+        for frames that are not keyframes. """
+    if opt.temporal and not selector.is_keyframe(image):
+        return None
+    if opt.tiled:
+        return extract_tiles(image, tile_size=tile_size, stride=stride, model_dims=input_dims)
+    return np.expand_dims(cv2.resize(image, input_dims), axis=0)
+
+
+def infer(inputs, model, session):
+    """ Runs the model inputs of several frames as a single batch. Returns
+        a list with the model outputs for each frame. Class probabilities
+        of each tile in tiled mode, or the predicted mask otherwise.
+        Frames whose inputs are None are skipped, and get None outputs. """
+    keep = [x for x in inputs if x is not None]
+    if len(keep) == 0:
+        return [None]*len(inputs)
+    X = np.concatenate(keep, axis=0)
+    if opt.tiled:
+        out = model.predict_probs_in_session(X, session=session, batch_size=len(X))
+    else:
+        out = model.predict_in_session(X, session=session, batch_size=len(X), verbose=False)
+        out = out.reshape(X.shape[:3])
+    outs = iter(np.split(out, np.cumsum([len(x) for x in keep])[:-1]))
+    return [None if x is None else next(outs) for x in inputs]
+
+
+def postprocess(image, out):
+    """ Given the original frame and the model outputs for it, it returns
+        the frame with the road pixels overlayed in red. If the outputs are
+        None (frame was skipped), the previous prediction is reused. """
+    height, width, _ = image.shape
+    if out is None:
+        pred = last_pred[0]
+    elif opt.tiled:
+        pred = blend_tiles(out, image.shape, tile_size=tile_size, stride=stride).argmax(axis=-1)
+    else:
+        pred = out[0]
+    last_pred[0] = pred
+    mask = np.zeros(list(pred.shape)+[3], dtype=np.uint8)
+    mask[:,:,2] = (pred == 1)*255
+    if mask.shape[:2] != (height, width):
+        mask = cv2.resize(mask, (width,  height))
+    return cv2.addWeighted(image,0.7,mask,0.5,0)
+
+
+def write_frame(overlayed):
+    """ Saves the frame to the output video file (if one is being saved) """
+    if out_video_path != "":
+        outvid = cv2.resize(overlayed, out_vid_dims)
+        out.write(outvid)
+
+
+################################################################################
+#                                                                       PIPELINE
+################################################################################
+try:
+    import queue
+except ImportError: # python 2.7
+    import Queue as queue
+
+END = None  # Sentinel passed down the pipeline once there are no more frames
+
+
+def run_pipeline(cap, model, session, batch_size=8, queue_size=4):
+    """ Processes the whole video with the following stages connected by
+        bounded queues:
+
+            decode thread -> preprocess thread (batches frames) ->
+            inference (this thread, owns the session) -> postprocess/encode thread
+
+        Each stage runs in a single thread, so the order of the frames is
+        preserved. Returns the number of frames processed.
+    """
+    frames_q = queue.Queue(maxsize=queue_size*batch_size)
+    batches_q = queue.Queue(maxsize=queue_size)
+    preds_q = queue.Queue(maxsize=queue_size)
+    errors = []
+    n_frames = [0]
+
+    def put(q, item):
+        # Give up putting items if a later stage crashed and stopped reading
+        while not errors:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(q):
+        # Treat a crash in any stage as the end of the stream
+        while not errors:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return END
+
+    def stage(func):
+        def wrapper():
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=wrapper)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def decode():
+        while cap.isOpened() and not errors:
+            ret, image = cap.read()
+            if not ret:
+                break
+            put(frames_q, image)
+        put(frames_q, END)
+
+    def batch_frames():
+        done = False
+        while not done:
+            images = []
+            while len(images) < batch_size:
+                image = get(frames_q)
+                if image is END:
+                    done = True
+                    break
+                images.append(image)
+            if len(images) > 0:
+                put(batches_q, (images, [preprocess(image) for image in images]))
+        put(batches_q, END)
+
+    def encode():
+        while True:
+            item = get(preds_q)
+            if item is END:
+                break
+            for image, out in zip(*item):
+                write_frame(postprocess(image, out))
+                n_frames[0] += 1
+
+    threads = [stage(decode), stage(batch_frames), stage(encode)]
+
+    # INFERENCE
+    try:
+        while True:
+            item = get(batches_q)
+            if item is END:
+                break
+            images, inputs = item
+            put(preds_q, (images, infer(inputs, model, session)))
+    except Exception as e:
+        errors.append(e)
+    put(preds_q, END)
+
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return n_frames[0]
+
+
 ################################################################################
 #                                                            START VIDEO STREAM
 ################################################################################
-ModelClass = arc[opt.arc]
-model = ModelClass(name=opt.name, pretrained_snapshot=None, img_shape=[opt.img_dim, opt.img_dim], n_channels=3, n_classes=1, dynamic=False, best_evals_metric="valid_iou")
-model.create_graph()
+model = load_model(opt.arc, name=opt.name, img_dim=opt.img_dim, graph=opt.graph)
+input_dims = (model.img_width, model.img_height)
+
+# TEMPORAL REUSE SETTINGS
+selector = KeyframeSelector(threshold=opt.change_threshold, max_interval=opt.keyframe_interval, budget=opt.inference_budget)
+last_pred = [None]  # Last prediction made (list so functions can modify it)
+
+# TILING SETTINGS
+tile_size, stride = None, None
+if opt.tiled:
+    tile_size = opt.tile_size if opt.tile_size is not None else input_dims[0]
+    stride = opt.stride if opt.stride is not None else tile_size - opt.overlap
+    assert 0 < stride <= tile_size, "stride must be between 1 and the tile size ({}). Use a smaller --overlap or --stride".format(tile_size)
 
 with model.create_session() as session:
     model.initialize_vars(session=session, best=opt.best)
     # START CAPTURE
     cap = cv2.VideoCapture(video_path)
-    while(cap.isOpened()):
+    t0 = time.time()
+    n_frames = 0
+    if opt.pipeline:
+        n_frames = run_pipeline(cap, model, session, batch_size=opt.batch_size, queue_size=opt.queue_size)
+    while(cap.isOpened() and not opt.pipeline):
         ret, image = cap.read()
         if ret == True:
             # scaled = cv2.resize(image, (96,  32))
-            scaled = cv2.resize(image, input_dims)
             if image is None:
                 print("NO IMAGE!!!!")
 
-
-            height, width, _ = image.shape
-            pred = np.zeros_like(scaled)
-            pred[:,:,2] = model.predict(np.expand_dims(scaled, axis=0), verbose=False, session=session) == 1
-            pred = pred * 255
-
-            pred = cv2.resize(pred, (width,  height))
-            overlayed = cv2.addWeighted(image,0.7,pred,0.5,0)
+            pred_out = infer([preprocess(image)], model, session)[0]
+            overlayed = postprocess(image, pred_out)
             if SHOW_VID:
                 cv2.imshow('Stack', overlayed)
 
             # SAVE THE FRAME TO VIDEO FILE
-            if out_video_path != "":
-                outvid = cv2.resize(overlayed, out_vid_dims)
-                out.write(outvid)
+            write_frame(overlayed)
+            n_frames += 1
 
             # Quit if Escape button pressed
             k = cv2.waitKey(1) & 0xFF
@@ -84,6 +268,10 @@ with model.create_session() as session:
         else:
             break
 
+    duration = time.time() - t0
+    print("Processed {} frames in {:0.2f} s ({:0.2f} frames/sec)".format(n_frames, duration, n_frames/max(duration, 1e-9)))
+    if opt.temporal:
+        print("Ran inference on {} of {} frames ({:0.1f}%), final change threshold: {:0.4f}".format(selector.n_keyframes, selector.n_frames, 100*selector.inference_rate, selector.threshold))
     cap.release()
     if out_video_path != "":
         out.release()